@@ -0,0 +1,351 @@
+#  -*- coding: utf-8 -*-
+""" A pure Python/NumPy reader and scorer for ARPA language models (the output
+of `ngram-count -lm`). It has the same interface as the parts of the srilm
+module that translate uses, so it can stand in when the _srilm extension
+isn't built.
+
+Words are mapped to integer ids, and each n-gram is packed into an int64 key
+(the last ids of n-grams too long for one key, with a big vocabulary, go in a
+second "high" key). For each order n there are contiguous arrays of keys,
+log10 probabilities and backoff weights, plus an open-addressing hash table of
+row numbers.
+
+Those arrays can be saved to a directory (save) and memory-mapped back
+(load, or loadshared to convert an ARPA file the first time), with the vocabulary
+in a compiled lexicon, so every process that loads the LM shares one copy.
+"""
+import gzip
+import json
+import os
+
+import numpy as np
+
+import lexcache
+from utils import logger, atomicwrite, newerthan
+
+# what SRILM returns for a word it has never seen
+LOGP_ZERO = float("-inf")
+
+# for the multiplicative hash of packed keys
+HASHMULT = 0x9E3779B97F4A7C15
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+class ARPALM:
+
+    def __init__(self, order):
+        self.order = order
+        self.vocab = {}
+        self.unk = 0
+        self.bits = 1
+        # how many ids fit in one key
+        self.split = 63
+
+        # per order n (index n-1): packed keys, high keys (None if n <= split),
+        # probs, bows, hash slots.
+        self.keys = []
+        self.hikeys = []
+        self.probs = []
+        self.bows = []
+        self.slots = []
+        self.shifts = []
+
+    def index(self, word):
+        """ The id of word, or the id of <unk> (0 if there is no <unk>) """
+        return self.vocab.get(word, self.unk)
+
+    def pack(self, ids):
+        """ The (high, low) keys of ids: the last self.split ids go in the low key """
+        key = 0
+        for i in ids[-self.split:]:
+            key = (key << self.bits) | i
+        hi = 0
+        for i in ids[:-self.split]:
+            hi = (hi << self.bits) | i
+        return hi, key
+
+    def find(self, n, key):
+        """ Row of the packed n-gram key in the order n tables, or -1 """
+        hi, key = key
+        slots = self.slots[n-1]
+        keys = self.keys[n-1]
+        hikeys = self.hikeys[n-1]
+        mask = len(slots) - 1
+        h = (key * HASHMULT) & MASK64
+        if hi:
+            h = ((h ^ hi) * HASHMULT) & MASK64
+        slot = h >> self.shifts[n-1]
+        while True:
+            row = int(slots[slot]) - 1
+            if row == -1:
+                return -1
+            if keys[row] == key and (hikeys is None or hikeys[row] == hi):
+                return row
+            slot = (slot + 1) & mask
+
+    def wordprob(self, ids):
+        """ log10 P(ids[-1] | ids[:-1]), backing off to shorter contexts """
+        if ids[-1] == 0:
+            return LOGP_ZERO
+
+        ids = ids[-len(self.keys):]
+        bow = 0.0
+        for n in range(len(ids), 0, -1):
+            row = self.find(n, self.pack(ids[-n:]))
+            if row != -1:
+                return float(self.probs[n-1][row]) + bow
+
+            if n > 1:
+                crow = self.find(n-1, self.pack(ids[-n:-1]))
+                if crow != -1:
+                    bow += float(self.bows[n-2][crow])
+        return LOGP_ZERO
+
+    def wordprobs(self, ids, lengths):
+        """ Vectorized wordprob. ids is an int64 matrix with one n-gram per row,
+        right-aligned and padded on the left with 0; lengths are the true lengths. """
+        num, width = ids.shape
+        result = np.full(num, LOGP_ZERO)
+        bow = np.zeros(num)
+        done = ids[:, -1] == 0
+
+        for n in range(min(width, len(self.keys)), 0, -1):
+            active = ~done & (lengths >= n)
+            if not active.any():
+                continue
+
+            rows = self.findmany(n, self.packmany(ids[active, width-n:]))
+            found = rows != -1
+            idx = np.flatnonzero(active)
+            result[idx[found]] = self.probs[n-1][rows[found]] + bow[idx[found]]
+            done[idx[found]] = True
+
+            if n > 1:
+                idx = idx[~found]
+                crows = self.findmany(n-1, self.packmany(ids[idx, width-n:width-1]))
+                cfound = crows != -1
+                bow[idx[cfound]] += self.bows[n-2][crows[cfound]]
+
+        return result
+
+    def packmany(self, ids):
+        """ Vectorized pack, of the rows of ids """
+        split = max(0, ids.shape[1] - self.split)
+        keys = np.zeros(len(ids), dtype=np.int64)
+        for j in range(split, ids.shape[1]):
+            keys = (keys << self.bits) | ids[:, j]
+        hi = np.zeros(len(ids), dtype=np.int64)
+        for j in range(split):
+            hi = (hi << self.bits) | ids[:, j]
+        return hi, keys
+
+    def hashmany(self, keys, n):
+        hi, keys = keys
+        h = keys.astype(np.uint64) * np.uint64(HASHMULT)
+        if hi.any():
+            h = np.where(hi != 0, (h ^ hi.astype(np.uint64)) * np.uint64(HASHMULT), h)
+        return (h >> np.uint64(self.shifts[n-1])).astype(np.int64)
+
+    def findmany(self, n, keys):
+        """ Vectorized find """
+        slots = self.slots[n-1]
+        tkeys = self.keys[n-1]
+        thikeys = self.hikeys[n-1]
+        mask = len(slots) - 1
+        hi, keys = keys
+
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        pos = self.hashmany((hi, keys), n)
+        pending = np.arange(len(keys))
+        while len(pending) > 0:
+            row = slots[pos].astype(np.int64) - 1
+            hit = row != -1
+            match = np.zeros(len(pending), dtype=bool)
+            match[hit] = tkeys[row[hit]] == keys[pending[hit]]
+            if thikeys is not None:
+                match[hit] &= thikeys[row[hit]] == hi[pending[hit]]
+            rows[pending[match]] = row[match]
+
+            # keep probing only where the slot was taken by some other key.
+            cont = hit & ~match
+            pending = pending[cont]
+            pos = (pos[cont] + 1) & mask
+        return rows
+
+    def build(self, n, keys, probs, bows):
+        """ Installs the tables for order n. keys are (high, low) key arrays. """
+        size = 8
+        while size < 2 * len(keys[1]):
+            size *= 2
+        self.keys.append(keys[1])
+        self.hikeys.append(keys[0] if n > self.split else None)
+        self.probs.append(probs)
+        self.bows.append(bows)
+        self.shifts.append(64 - (size.bit_length() - 1))
+
+        slots = np.zeros(size, dtype=np.int32)
+        pos = self.hashmany(keys, n)
+        rows = np.arange(len(keys[1]))
+        while len(rows) > 0:
+            free = slots[pos] == 0
+            # several rows may want the same free slot, only one of them gets it.
+            _, first = np.unique(pos[free], return_index=True)
+            placed = np.flatnonzero(free)[first]
+            slots[pos[placed]] = rows[placed] + 1
+
+            left = np.ones(len(rows), dtype=bool)
+            left[placed] = False
+            rows = rows[left]
+            pos = (pos[left] + 1) & (size - 1)
+        self.slots.append(slots)
+
+    def __repr__(self):
+        return "<ARPALM order {0}, {1} words>".format(self.order, len(self.vocab))
+
+
+def initLM(order):
+    return ARPALM(order)
+
+
+def readLM(lm, filename):
+    """ Reads an ARPA file (plain or gzipped) into lm. N-grams longer than
+    lm.order are skipped. """
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rt", encoding="utf-8") as f:
+        counts = {}
+        section = 0
+        grams = []
+
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            if line.startswith("\\"):
+                if section > 0 and section <= lm.order:
+                    install(lm, section, grams)
+                grams = []
+                if line == "\\end\\":
+                    break
+                if line.endswith("-grams:"):
+                    section = int(line[1:line.index("-")])
+                continue
+
+            if section == 0:
+                if line.startswith("ngram "):
+                    n, c = line[6:].split("=")
+                    counts[int(n)] = int(c)
+                continue
+
+            if section <= lm.order:
+                grams.append(line.split())
+
+    logger.info("Read ARPA LM {0}: {1}".format(filename, counts))
+    return 1
+
+
+def install(lm, n, grams):
+    """ Converts the parsed lines of the n-gram section into tables """
+    if n == 1:
+        for i, g in enumerate(grams):
+            lm.vocab[g[1]] = i + 1
+        lm.unk = lm.vocab.get("<unk>", 0)
+        lm.bits = max(1, len(lm.vocab).bit_length())
+        # n-grams of more than split words also get a high key (see pack).
+        lm.split = 63 // lm.bits
+
+    keys = np.zeros(len(grams), dtype=np.int64)
+    hikeys = np.zeros(len(grams), dtype=np.int64)
+    probs = np.zeros(len(grams), dtype=np.float32)
+    bows = np.zeros(len(grams), dtype=np.float32)
+    for i, g in enumerate(grams):
+        probs[i] = float(g[0])
+        hikeys[i], keys[i] = lm.pack([lm.vocab.get(w, 0) for w in g[1:n+1]])
+        if len(g) > n + 1:
+            bows[i] = float(g[n+1])
+
+    lm.build(n, (hikeys, keys), probs, bows)
+
+
+def getNgramProb(lm, ngramstr, order):
+    """ log10 probability of the last word of ngramstr given the words before it
+    (ngramstr has order words) """
+    words = ngramstr.split()
+    return lm.wordprob([lm.index(w) for w in words[-order:]])
+
+
+def getNgramProbs(lm, ngrams):
+    """ Scores many n-grams in one vectorized call. ngrams is a list of lists of
+    words (context followed by the word). Returns a numpy array of log10 probabilities. """
+    width = max(1, max(map(len, ngrams))) if len(ngrams) > 0 else 1
+    ids = np.zeros((len(ngrams), width), dtype=np.int64)
+    lengths = np.zeros(len(ngrams), dtype=np.int64)
+    for i, g in enumerate(ngrams):
+        if len(g) > 0:
+            ids[i, width-len(g):] = [lm.index(w) for w in g]
+        lengths[i] = len(g)
+    return lm.wordprobs(ids, lengths)
+
+
+def save(lm, dirname, source=None):
+    """ Writes the tables of lm to dirname, to be memory-mapped by load """
+    words = sorted(lm.vocab, key=lm.vocab.get)
+    if [lm.vocab[w] for w in words] != list(range(1, len(words) + 1)):
+        raise ValueError("LM vocabulary ids are not contiguous (repeated unigrams?)")
+
+    os.makedirs(dirname, exist_ok=True)
+    lexcache.writelexicon({w: {} for w in words}, os.path.join(dirname, "vocab.lex"))
+    for n in range(len(lm.keys)):
+        for name, arrays in [("keys", lm.keys), ("probs", lm.probs), ("bows", lm.bows), ("slots", lm.slots),
+                             ("hikeys", lm.hikeys)]:
+            if arrays[n] is not None:
+                np.save(os.path.join(dirname, "{0}{1}.npy".format(name, n + 1)), arrays[n])
+
+    meta = {"order": lm.order, "orders": len(lm.keys), "unk": lm.unk, "bits": lm.bits, "split": lm.split,
+            "shifts": lm.shifts,
+            "source": os.path.abspath(source) if source else None}
+    # written last, so a directory with meta.json is complete.
+    with atomicwrite(os.path.join(dirname, "meta.json")) as out:
+        json.dump(meta, out)
+    logger.info("Saved LM tables to " + dirname)
+
+
+def load(dirname):
+    """ An ARPALM with its tables memory-mapped (read-only) from a directory written by save """
+    with open(os.path.join(dirname, "meta.json")) as f:
+        meta = json.load(f)
+
+    lm = ARPALM(meta["order"])
+    lm.vocab = lexcache.MappedVocab(lexcache.CompiledLexicon(os.path.join(dirname, "vocab.lex")), 1)
+    lm.unk = meta["unk"]
+    lm.bits = meta["bits"]
+    lm.split = meta.get("split", 63 // lm.bits)
+    lm.shifts = meta["shifts"]
+    for n in range(meta["orders"]):
+        for name, arrays in [("keys", lm.keys), ("probs", lm.probs), ("bows", lm.bows), ("slots", lm.slots)]:
+            arrays.append(np.load(os.path.join(dirname, "{0}{1}.npy".format(name, n + 1)), mmap_mode="r"))
+        lm.hikeys.append(np.load(os.path.join(dirname, "hikeys{0}.npy".format(n + 1)), mmap_mode="r")
+                         if n + 1 > lm.split else None)
+    return lm
+
+
+def savedfrom(dirname):
+    """ (ARPA file, order) of the tables saved in dirname, or None """
+    metaname = os.path.join(dirname, "meta.json")
+    if not os.path.exists(metaname):
+        return None
+    with open(metaname) as f:
+        meta = json.load(f)
+    return meta.get("source"), meta.get("order")
+
+
+def loadshared(filename, dirname, order):
+    """ Memory-maps the LM in filename from its tables in dirname, reading the ARPA
+    file and saving the tables there first if they are missing or stale. """
+    if not (savedfrom(dirname) == (os.path.abspath(filename), order)
+            and newerthan([os.path.join(dirname, "meta.json")], [filename])):
+        lm = initLM(order)
+        readLM(lm, filename)
+        save(lm, dirname, filename)
+    logger.info("Mapping LM tables from " + dirname)
+    return load(dirname)
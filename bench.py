@@ -0,0 +1,297 @@
+#  -*- coding: utf-8 -*-
+""" Benchmarks for lexicon loading and translation throughput, on synthetic data.
+
+Everything is generated from a seed: Pavlick-format lexicons for two foreign
+languages over a shared English vocabulary, a CoNLL corpus with a given rate
+of out-of-vocabulary words, and a small trigram ARPA LM over the target words.
+No network or real dictionaries are needed.
+
+Each measurement runs in a fresh interpreter (so imports, caches and peak
+memory don't leak from one into the next), is repeated, and the fastest run
+is kept. The results are written as json, to compare between versions:
+
+    $ python bench.py --out bench-before.json
+    $ git checkout ... && python bench.py --out bench-after.json
+"""
+import codecs
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+
+from utils import logger
+
+# the synthetic languages: English, the target, and a second language to pivot from
+SOURCE = "eng"
+TARGET = "syn"
+PIVOT = "piv"
+
+
+def makeword(rng, minlen=3, maxlen=10):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(minlen, maxlen)))
+
+
+def makevocab(rng, size):
+    """ size distinct random words """
+    vocab = set()
+    while len(vocab) < size:
+        vocab.add(makeword(rng))
+    return sorted(vocab)
+
+
+def phraselength(rng, weights):
+    """ A phrase length drawn from weights (the weight of length 1, 2, ...) """
+    return rng.choices(range(1, len(weights) + 1), weights)[0]
+
+
+def makelexicon(fname, rng, engvocab, size, phraselens, maxdefs=3):
+    """ Writes a Pavlick-format lexicon (foreign word, then tab separated English
+    definitions) with size entries. Returns the foreign words. """
+    fvocab = makevocab(rng, size)
+    with codecs.open(fname, "w", "utf8") as out:
+        for f in fvocab:
+            defs = [" ".join(rng.choice(engvocab) for _ in range(phraselength(rng, phraselens)))
+                    for _ in range(rng.randint(1, maxdefs))]
+            out.write(f + "\t" + "\t".join(defs) + "\n")
+    return fvocab
+
+
+def makecorpus(fname, rng, engvocab, sentences, sentlen, oovrate):
+    """ Writes a CoNLL corpus. Each word is unknown (not in engvocab) with probability
+    oovrate. Returns the number of tokens. """
+    tokens = 0
+    with codecs.open(fname, "w", "utf8") as out:
+        for _ in range(sentences):
+            for i in range(max(1, int(rng.gauss(sentlen, sentlen / 3.)))):
+                w = makeword(rng) if rng.random() < oovrate else rng.choice(engvocab)
+                if rng.random() < 0.1:
+                    w = w.capitalize()
+                tag = "O" if rng.random() > 0.1 else "B-PER"
+                out.write("\t".join([tag, "0", str(i), "x", "x", w, "x", "x", "0"]) + "\n")
+                tokens += 1
+            out.write("\n")
+    return tokens
+
+
+def makelm(fname, rng, words, bigrams, trigrams):
+    """ Writes a trigram ARPA LM with every word as a unigram, and random bi- and trigrams """
+    words = ["<s>", "</s>", "<unk>"] + sorted(set(words))
+    bi = sorted({(rng.choice(words), rng.choice(words)) for _ in range(bigrams)})
+    tri = sorted({b + (rng.choice(words),) for b in rng.sample(bi, min(len(bi), trigrams))})
+
+    def logp():
+        return -round(rng.uniform(0.5, 5), 4)
+
+    with codecs.open(fname, "w", "utf8") as out:
+        out.write("\n\\data\\\n")
+        out.write("ngram 1={0}\nngram 2={1}\nngram 3={2}\n".format(len(words), len(bi), len(tri)))
+        out.write("\n\\1-grams:\n")
+        for w in words:
+            out.write("{0}\t{1}\t{2}\n".format(logp(), w, logp() / 5))
+        out.write("\n\\2-grams:\n")
+        for g in bi:
+            out.write("{0}\t{1}\t{2}\n".format(logp(), " ".join(g), logp() / 5))
+        out.write("\n\\3-grams:\n")
+        for g in tri:
+            out.write("{0}\t{1}\n".format(logp(), " ".join(g)))
+        out.write("\n\\end\\\n")
+
+
+def generate(workdir, config):
+    """ Writes the synthetic lexicons, corpus and LM for config into workdir """
+    rng = random.Random(config["seed"])
+    phraselens = config["phraselens"]
+
+    engvocab = makevocab(rng, config["vocab"])
+    tgtvocab = makelexicon(os.path.join(workdir, "dict." + TARGET), rng, engvocab, config["entries"], phraselens)
+    makelexicon(os.path.join(workdir, "dict." + PIVOT), rng, engvocab, config["entries"], phraselens)
+    tokens = makecorpus(os.path.join(workdir, "corpus.conll"), rng, engvocab,
+                        config["sentences"], config["sentlen"], config["oov"])
+    makelm(os.path.join(workdir, "lm.arpa"), rng, tgtvocab, config["lmbigrams"], config["lmtrigrams"])
+    return tokens
+
+
+def configure(workdir, lm):
+    """ Points the config variables (see utils.py) at the synthetic data """
+    import utils
+    import lexicons
+    import translate
+
+    lmpath = os.path.join(workdir, "lm.arpa") if lm else os.path.join(workdir, "nolm")
+    for mod in [utils, lexicons, translate]:
+        mod.LEXICONPATH = workdir + "/"
+        mod.COMPILEDPATH = os.path.join(workdir, "compiled") + "/"
+        mod.USEMASTERLEX = False
+        mod.USEPAVLICK = True
+        mod.LMPATH = lmpath
+
+
+def clearcompiled(workdir):
+    compiled = os.path.join(workdir, "compiled")
+    if os.path.isdir(compiled):
+        for fname in os.listdir(compiled):
+            os.remove(os.path.join(compiled, fname))
+
+
+# each of these runs in a fresh process and returns a dict of measurements.
+
+def bench_readlexicon(workdir):
+    configure(workdir, False)
+    import lexicons
+    start = time.perf_counter()
+    e2f, f2e, pairs = lexicons.readlexicon(lexicons.dictname(TARGET))
+    return {"seconds": time.perf_counter() - start, "keys": len(e2f), "pairs": len(pairs)}
+
+
+def bench_mapping(workdir):
+    configure(workdir, False)
+    import lexicons
+    start = time.perf_counter()
+    dct, _ = lexicons.getlexiconmapping(SOURCE, TARGET)
+    return {"seconds": time.perf_counter() - start, "keys": len(dct)}
+
+
+def bench_pivotmapping(workdir):
+    configure(workdir, False)
+    import lexicons
+    start = time.perf_counter()
+    dct, _ = lexicons.getlexiconmapping(PIVOT, TARGET)
+    return {"seconds": time.perf_counter() - start, "keys": len(dct)}
+
+
+def bench_startup_cold(workdir):
+    """ Translator startup with nothing compiled yet """
+    clearcompiled(workdir)
+    configure(workdir, True)
+    import translate
+    start = time.perf_counter()
+    translate.Translator("lexicon", SOURCE, TARGET)
+    return {"seconds": time.perf_counter() - start}
+
+
+def bench_startup_warm(workdir):
+    """ Translator startup with the compiled lexicon in place """
+    configure(workdir, True)
+    import lexicons
+    lexicons.loadcompiled(SOURCE, TARGET)
+    import translate
+    start = time.perf_counter()
+    translate.Translator("lexicon", SOURCE, TARGET)
+    return {"seconds": time.perf_counter() - start}
+
+
+def translatecorpus(workdir, lm):
+    configure(workdir, lm)
+    import translate
+    from utils import readconll, getword
+    tt = translate.Translator("lexicon", SOURCE, TARGET)
+    lines = readconll(os.path.join(workdir, "corpus.conll"))
+    tokens = sum(1 for line in lines if getword(line) is not None)
+
+    start = time.perf_counter()
+    tt.translate(lines)
+    elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "tokens": tokens, "tokens_per_second": tokens / elapsed}
+
+
+def bench_translate_nolm(workdir):
+    return translatecorpus(workdir, False)
+
+
+def bench_translate_lm(workdir):
+    return translatecorpus(workdir, True)
+
+
+BENCHMARKS = ["readlexicon", "mapping", "pivotmapping", "startup_cold", "startup_warm",
+              "translate_nolm", "translate_lm"]
+
+
+def _runone(name, workdir):
+    import lexicons
+    result = globals()["bench_" + name](workdir)
+    rss = lexicons.maxrss()
+    result["peak_rss_mb"] = rss if not math.isnan(rss) else None
+    return result
+
+
+def run(name, workdir, repeat):
+    """ Runs a benchmark repeat times, each in a new process. Returns the fastest run. """
+    ctx = multiprocessing.get_context("spawn")
+    best = None
+    for _ in range(repeat):
+        with ctx.Pool(1) as pool:
+            result = pool.apply(_runone, (name, workdir))
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    logger.info("{0}: {1:.3f}s".format(name, best["seconds"]))
+    return best
+
+
+def gitversion():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.DEVNULL)
+        return out.decode("utf8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(config, workdir, outfname, benchmarks=BENCHMARKS):
+    os.makedirs(workdir, exist_ok=True)
+    logger.info("Generating synthetic data in " + workdir)
+    tokens = generate(workdir, config)
+
+    results = {}
+    for name in benchmarks:
+        results[name] = run(name, workdir, config["repeat"])
+
+    report = {"config": config, "corpus_tokens": tokens, "results": results,
+              "version": gitversion(), "python": platform.python_version(),
+              "machine": platform.machine(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    with open(outfname, "w") as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+    logger.info("Wrote " + outfname)
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark lexicon loading and translation on synthetic data")
+
+    parser.add_argument("--out", "-o", help="Json file to write results to", default="bench.json")
+    parser.add_argument("--workdir", help="Where to put the synthetic data (default: a temporary directory)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--vocab", help="English vocabulary size", type=int, default=20000)
+    parser.add_argument("--entries", help="Entries in each foreign lexicon", type=int, default=50000)
+    parser.add_argument("--phraselens", help="Weights of English phrase lengths 1, 2, ... in the lexicons",
+                        default="0.7,0.2,0.1")
+    parser.add_argument("--sentences", help="Sentences in the corpus", type=int, default=2000)
+    parser.add_argument("--sentlen", help="Mean sentence length", type=int, default=20)
+    parser.add_argument("--oov", help="Rate of out-of-vocabulary words in the corpus", type=float, default=0.05)
+    parser.add_argument("--lmbigrams", type=int, default=100000)
+    parser.add_argument("--lmtrigrams", type=int, default=50000)
+    parser.add_argument("--repeat", help="Runs of each benchmark (the fastest is kept)", type=int, default=3)
+    parser.add_argument("--only", help="Comma separated benchmarks to run", default=",".join(BENCHMARKS))
+
+    args = parser.parse_args()
+
+    config = dict(seed=args.seed, vocab=args.vocab, entries=args.entries,
+                  phraselens=[float(w) for w in args.phraselens.split(",")],
+                  sentences=args.sentences, sentlen=args.sentlen, oov=args.oov,
+                  lmbigrams=args.lmbigrams, lmtrigrams=args.lmtrigrams, repeat=args.repeat)
+
+    benchmarks = args.only.split(",")
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark: " + name)
+
+    if args.workdir:
+        main(config, args.workdir, args.out, benchmarks)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            main(config, workdir, args.out, benchmarks)
@@ -0,0 +1,121 @@
+#  -*- coding: utf-8 -*-
+""" Checkpoints of a long translation run, so that it can be resumed.
+
+A checkpoint is taken at a sentence boundary, after the output up to there
+has been flushed to disk. It records how far the run had read the input and
+written the output (as byte offsets), how many sentences that was, and the
+coverage counts so far. To resume, the output is cut back to its offset and
+appended to, and the input is read from its offset.
+
+The words missed so far would make every checkpoint bigger than the last, so
+the words missed since the last checkpoint are appended to a side file (the
+checkpoint name plus .missed) instead, and the checkpoint records its length.
+
+Checkpoints are small json files written to a temporary file and renamed over
+the last one, so a crash never leaves a half written checkpoint.
+"""
+import json
+import os
+from collections import Counter
+
+from utils import logger, atomicwrite, getword, plaintexttolines
+
+# take a checkpoint after about this many sentences
+EVERY = 5000
+
+
+def checkpointname(outfname):
+    return outfname + ".ckpt"
+
+
+def seekable(outfname):
+    """ Whether outfname can be cut back and appended to: a regular file, or nothing yet """
+    import stat
+    return not os.path.exists(outfname) or stat.S_ISREG(os.stat(outfname).st_mode)
+
+
+def readfrom(fname, format, start=0, boundaries=None):
+    """ The conll lines of fname (a conll or plaintext file), read from byte offset
+    start, which must be the start of a line. If boundaries is given, the offset
+    just after each sentence boundary is appended to it as the boundary is read. """
+    offset = start
+    with open(fname, "rb") as f:
+        f.seek(start)
+        for raw in f:
+            # split like codecs does, so the lines are the same as with iterconll
+            for line in raw.decode("utf-8").splitlines(True):
+                offset += len(line.encode("utf-8"))
+                if format == "conll":
+                    if boundaries is not None and getword(line) is None:
+                        boundaries.append(offset)
+                    yield line
+                else:
+                    for outline in plaintexttolines(line):
+                        yield outline
+                    if boundaries is not None:
+                        boundaries.append(offset)
+                    yield "\n"
+
+
+class Checkpoint:
+
+    def __init__(self, fname, infname, outfname, format, spec):
+        """ A checkpoint in fname of translating infname to outfname (in format),
+        with a Translator made from spec. """
+        self.fname = fname
+        self.run = {"input": os.path.abspath(infname), "output": os.path.abspath(outfname),
+                    "format": format, "spec": spec}
+        st = os.stat(infname)
+        self.inputstamp = [st.st_size, st.st_mtime]
+
+        # the missed words, one json [word, count] per line
+        self.missedname = fname + ".missed"
+        self.missedoffset = 0
+
+    def save(self, inoffset, outoffset, sentences, stats, missed):
+        """ Atomically replace the checkpoint. stats is a json-able dict of the counts
+        so far, and missed is a dict of the words missed (and how often) since the
+        last checkpoint. """
+        with open(self.missedname, "ab") as out:
+            # anything after the last checkpoint (or of an earlier run) goes.
+            out.truncate(self.missedoffset)
+            for w, count in missed.items():
+                out.write((json.dumps([w, count]) + "\n").encode("utf-8"))
+            out.flush()
+            os.fsync(out.fileno())
+            self.missedoffset = out.tell()
+
+        state = dict(self.run, inputstamp=self.inputstamp, inoffset=inoffset, outoffset=outoffset,
+                     sentences=sentences, stats=stats, missedoffset=self.missedoffset)
+        with atomicwrite(self.fname) as out:
+            json.dump(state, out)
+
+    def load(self):
+        """ The saved state, or None if there is no checkpoint. Its missedwords are the
+        counts of the words missed up to it. Raises ValueError if the checkpoint is of
+        a different run, or the input has changed since. """
+        if not os.path.exists(self.fname):
+            return None
+        with open(self.fname) as f:
+            state = json.load(f)
+        for k, v in self.run.items():
+            if state[k] != v:
+                raise ValueError("Checkpoint {0} has a different {1}: {2}".format(self.fname, k, state[k]))
+        if state["inputstamp"] != self.inputstamp:
+            raise ValueError("{0} has changed since checkpoint {1}".format(self.run["input"], self.fname))
+
+        self.missedoffset = state["missedoffset"]
+        state["missedwords"] = Counter()
+        if self.missedoffset > 0:
+            with open(self.missedname, "rb") as f:
+                for line in f.read(self.missedoffset).decode("utf-8").splitlines():
+                    w, count = json.loads(line)
+                    state["missedwords"][w] += count
+        logger.info("Resuming after {0} sentences, from input byte {1}, output byte {2}".format(
+            state["sentences"], state["inoffset"], state["outoffset"]))
+        return state
+
+    def remove(self):
+        for fname in [self.fname, self.missedname]:
+            if os.path.exists(fname):
+                os.remove(fname)
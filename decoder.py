@@ -0,0 +1,157 @@
+#  -*- coding: utf-8 -*-
+""" Sentence-level beam search decoding for Translator.
+
+Instead of fixing each phrase greedily from left to right, decode builds a
+lattice of every phrase that matches the lexicon at every position (plus a
+pass-through edge where no phrase starts, as the greedy fallback), and searches
+it with a dynamic program over positions. Hypotheses that end at the same
+position with the same LM state (the last LMORDER-1 output words, their
+history) are recombined, and each position keeps only the best `beam` of them.
+
+An option is scored like in greedy decoding: the log of its lexicon weight plus
+the LM log probability of its first word given the history. A pass-through
+costs as much as an option of weight 0. Since LM log probabilities are never
+positive, hypothesis score plus log weight bounds the score of an extension.
+The extensions into a position are taken best bound first, and only as many of
+them are scored as the phrases ending there have options (cube pruning). So a
+position costs at most as many LM calls as greedy decoding spends on a phrase,
+however many hypotheses lead into it. Scores go through
+Translator.lmcache, so hypotheses that share a history share the calls.
+"""
+import heapq
+import math
+
+from utils import IGNORES
+
+# the LM state of a hypothesis is the last LMORDER-1 words
+LMORDER = 3
+
+# LM scores are floored at this, so one unknown word doesn't sink every hypothesis
+LOGP_FLOOR = -99.0
+
+# the score of a pass-through word: the same as a lexicon weight of 0
+PASSTHROUGH = math.log(0.0000001)
+
+
+def lattice(tt, sent):
+    """ For each position of sent, the list of (length, srcphrase) edges out of it, longest
+    first. A position where no phrase starts gets a (1, None) pass-through. """
+    edges = []
+    for i in range(len(sent)):
+        window = sent.words[i:i+tt.window]
+        lowers = sent.lowers[i:i+tt.window]
+        path = tt.trie.path(window)
+        lowpath = tt.trie.path(lowers)
+
+        out = []
+        for jj in range(len(window), 0, -1):
+            srcphrase = tt.lookup(window, lowers, path, lowpath, jj)
+            if srcphrase is not None:
+                out.append((jj, srcphrase))
+
+        if len(out) == 0:
+            out.append((1, None))
+        edges.append(out)
+    return edges
+
+
+def options(tt, srcphrase):
+    """ The best tt.beam (target, weight) options for srcphrase, best first """
+    opts = sorted(dict(tt.dct[srcphrase]).items(), key=lambda p: p[1], reverse=True)
+    return opts[:tt.beam]
+
+
+def bound(score, weight):
+    """ The best score a hypothesis can reach with an option of this weight """
+    if weight is None:
+        return score + PASSTHROUGH
+    return score + math.log(weight + 0.0000001)
+
+
+def extend(tt, score, state, opt, weight):
+    """ Score of a hypothesis extended with opt, and its new LM state. Only the
+    first word of opt is scored, the rest only extend the history. """
+    words = opt.split()
+    score = bound(score, weight)
+    if weight is not None and tt.lm and len(words) > 0:
+        score += max(LOGP_FLOOR, tt.lmcache.score(tt.lm, list(state), words[0]))
+    return score, (state + tuple(words))[1-LMORDER:]
+
+
+def decode(tt, sent, first, stats):
+    """ Translate one sentence (a TokenTable) with beam search. Returns the output
+    rows, like Translator.translate_sentence. """
+    words = sent.words
+    n = len(words)
+
+    # the edges into each position, with their options best first
+    incoming = [[] for _ in range(n + 1)]
+    for j, out in enumerate(lattice(tt, sent)):
+        for jj, srcphrase in out:
+            if srcphrase is None:
+                opts = [(words[j] if words[j] != "" else "x", None)]
+            else:
+                opts = options(tt, srcphrase)
+            incoming[j + jj].append((j, jj, opts))
+
+    # tops[j] is the best beam hypotheses that have translated the first j words,
+    # best first, as (LM state, (score, previous hypothesis, edge)).
+    tops = [[] for _ in range(n + 1)]
+    tops[0] = [((), (0.0, None, None))]
+
+    for k in range(1, n + 1):
+        # a heap of (-bound, edge, hypothesis index, option index). Each edge starts
+        # at its best pair, and popping a pair pushes its two next best neighbours.
+        heap = []
+        for e, (j, jj, opts) in enumerate(incoming[k]):
+            if len(tops[j]) > 0:
+                heap.append((-bound(tops[j][0][1][0], opts[0][1]), e, 0, 0))
+        heapq.heapify(heap)
+        seen = set((e, 0, 0) for _, e, _, _ in heap)
+
+        # no more LM calls than greedy decoding spends on a phrase (all its options)
+        limit = max([len(opts) for _, _, opts in incoming[k]] + [1])
+
+        stack = {}
+        pops = 0
+        while len(heap) > 0 and pops < limit:
+            _, e, h, o = heapq.heappop(heap)
+            pops += 1
+            j, jj, opts = incoming[k][e]
+            state, hyp = tops[j][h]
+            opt, weight = opts[o]
+
+            score, newstate = extend(tt, hyp[0], state, opt, weight)
+            old = stack.get(newstate)
+            if old is None or score > old[0]:
+                stack[newstate] = (score, hyp, (j, jj, opt if weight is not None else None))
+
+            for h2, o2 in ((h + 1, o), (h, o + 1)):
+                if h2 < len(tops[j]) and o2 < len(opts) and (e, h2, o2) not in seen:
+                    seen.add((e, h2, o2))
+                    heapq.heappush(heap, (-bound(tops[j][h2][1][0], opts[o2][1]), e, h2, o2))
+
+        tops[k] = sorted(stack.items(), key=lambda p: p[1][0], reverse=True)
+
+    # follow the back pointers from the best complete hypothesis.
+    hyp = tops[n][0][1]
+    path = []
+    while hyp[2] is not None:
+        path.append(hyp[2])
+        hyp = hyp[1]
+    path.reverse()
+
+    outrows = []
+    for i, jj, opt in path:
+        if opt is None:
+            outrows.append((i, sent.tags[i], words[i] if words[i] != "" else "x"))
+
+            if words[i] not in IGNORES:
+                stats.missing += 1
+                stats.missedwords[words[i]] += 1
+        else:
+            capitalize = len(outrows) == 0 and not first
+            outrows.extend(tt.outputrows(sent, i, jj, opt, capitalize))
+        stats.total += 1
+
+    return outrows
@@ -0,0 +1,29 @@
+#  -*- coding: utf-8 -*-
+""" Process pools forked from the current process.
+
+Forked workers inherit everything the parent has loaded (a Translator, a
+parsed corpus, read lexicons) without pickling it, and share its pages until
+they write to them. The gc is frozen while such a pool is up, so collections
+in the workers don't write to (and so copy) the pages of all those objects.
+"""
+import gc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def canfork():
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+class ForkPool(ProcessPoolExecutor):
+
+    def __init__(self, workers=None, initializer=None, initargs=()):
+        gc.freeze()
+        ProcessPoolExecutor.__init__(self, workers, mp_context=multiprocessing.get_context("fork"),
+                                     initializer=initializer, initargs=initargs)
+
+    def shutdown(self, wait=True, **kwargs):
+        try:
+            ProcessPoolExecutor.shutdown(self, wait, **kwargs)
+        finally:
+            gc.unfreeze()
@@ -1,67 +1,63 @@
-from googleapiclient.discovery import build
-import shelve
 import codecs
+import gtclient
+import transcache
 import utils
 
 API_KEY = utils.getapikey()
 
-def getgooglemapping(fname, source, target):
+# words per request, and requests in flight
+BATCHSIZE = 75
+WORKERS = 4
+
+def getgooglemapping(fname, source, target, endpoint=gtclient.ENDPOINT, workers=WORKERS, cachename=transcache.DEFAULTPATH):
     """
     Given a filename and a source and target languages, this will gather words
     from the the fifth column of each tab-sep row in fname and create a word
     mapping from source to target. Note that if Google cannot find a translation,
-    then it will simply return the word as is. 
-    
+    then it will simply return the word as is.
+
     Language codes are Google two letter codes (en, uz, tr, de, etc.)
 
-    Results are stored in python shelves.
+    Results are stored in the translation cache (see transcache.py). Returns a
+    dict of each word in fname to its translation.
     """
 
-    service = build('translate', 'v2',developerKey=API_KEY)
-    
-    memo = shelve.open("shelves/translatedict-" + source + "-" + target + ".shelf")
+    cache = transcache.TranslationCache(cachename)
 
+    # each distinct word, in order of appearance.
+    allwords = {}
     with codecs.open(fname, "r", "utf-8") as f:
-        lines = f.readlines()        
-
-    words = []
-    chars = 0
-    
-    for line in lines:            
-        sline = line.split("\t")
-        if len(sline) > 5:
-            srcword = sline[5].strip()
-            if srcword not in memo:
-                words.append(srcword)
-                chars += len(srcword)
+        for line in f:
+            sline = line.split("\t")
+            if len(sline) > 5:
+                allwords[sline[5].strip()] = True
+    allwords = list(allwords)
+
+    ret = cache.get_many(source, target, "word", allwords)
+    words = [w for w in allwords if w not in ret]
+    chars = sum(len(w) for w in words)
 
     # get the cost, fail if user refuses.
     utils.cost(chars)
-    
-    # gather a list of words to be translated.
-    for i in range(0, len(words), 20):
-        # Use 75 words at a time, to avoid API limits.
-        iwords = words[i:i+75]
-        print("size of request:",len(iwords))
-        try:
-            response = service.translations().list(source=source,target=target, q=iwords).execute()
-            if len(response["translations"]) > 0:
-                translations = response["translations"]
-                for w,t in zip(iwords,translations):
-                    tword = t["translatedText"]
-                    memo[w] = tword
-            else:
-                print("No translations in returned list...")
-
-        except Exception as e:
-            print("Whoops... exception")
-            print(e)
-            import traceback
-            traceback.print_exc()
-            
-
-    ret = dict(memo)
-    memo.close()
+
+    client = gtclient.TranslateClient(API_KEY, endpoint, workers)
+    done = 0
+    sent = 0
+    failed = 0
+    for iwords, translations in client.translateall(gtclient.chunkbycount(words, BATCHSIZE), source, target):
+        if translations is None:
+            failed += len(iwords)
+            continue
+        cache.put_many(source, target, "word", zip(iwords, translations))
+        ret.update(zip(iwords, translations))
+        done += len(iwords)
+        sent += sum(len(w) for w in iwords)
+        utils.costprogress(done, len(words), sent)
+
+    if failed > 0:
+        utils.logger.error("{0} words could not be translated, run again to retry them".format(failed))
+
+    cache.close()
     return ret
 
 if __name__ == "__main__":
@@ -71,9 +67,12 @@ if __name__ == "__main__":
     parser.add_argument("--input","-i", help="Input file name.", required=True)
     parser.add_argument("--source","-s", help="Source language code (2 letter)", default="en")
     parser.add_argument("--target","-t", help="Target language code (2 letter)", required=True)
+    parser.add_argument("--endpoint", help="Translate API endpoint (e.g. a local stub for testing)", default=gtclient.ENDPOINT)
+    parser.add_argument("--workers", "-w", help="Number of requests in flight", type=int, default=WORKERS)
+    parser.add_argument("--cache", help="Translation cache database", default=transcache.DEFAULTPATH)
+
 
-    
     args = parser.parse_args()
-    
-    dct = getgooglemapping(args.input,args.source, args.target)
+
+    dct = getgooglemapping(args.input,args.source, args.target, args.endpoint, args.workers, args.cache)
     print(dct)
@@ -0,0 +1,112 @@
+#  -*- coding: utf-8 -*-
+""" A small batch client for the Google Translate v2 REST API.
+
+Texts are sent in non-overlapping chunks, with a bounded number of requests in
+flight at once, and each request is retried with exponential backoff on
+rate-limit, server and network errors. The endpoint is a parameter, so the
+client can be pointed at a local stub server for testing.
+"""
+import json
+import random
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import logger
+
+ENDPOINT = "https://translation.googleapis.com/language/translate/v2"
+
+# HTTP codes that are worth retrying
+RETRYCODES = {408, 429, 500, 502, 503, 504}
+
+
+class TranslateClient:
+
+    def __init__(self, key, endpoint=ENDPOINT, workers=4, retries=5, backoff=1.0, timeout=60):
+        """ workers is the number of requests in flight, retries the number of times a
+        failed request is retried, backoff the first wait in seconds (it doubles each time). """
+        self.key = key
+        self.endpoint = endpoint
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def translatebatch(self, texts, source, target):
+        """ Translate a list of texts in one request, retrying on transient errors.
+        Returns the list of translations (html-escaped, as the API returns them). """
+        url = self.endpoint
+        if self.key:
+            url += "?" + urllib.parse.urlencode({"key": self.key})
+        body = json.dumps({"q": texts, "source": source, "target": target}).encode("utf8")
+
+        attempt = 0
+        while True:
+            try:
+                req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+                with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                    response = json.loads(resp.read().decode("utf8"))
+                translations = response["data"]["translations"]
+                if len(translations) != len(texts):
+                    raise ValueError("Asked for {0} translations, got {1}".format(len(texts), len(translations)))
+                return [t["translatedText"] for t in translations]
+
+            except urllib.error.HTTPError as e:
+                if e.code not in RETRYCODES or attempt >= self.retries:
+                    raise
+                reason = "HTTP {0}".format(e.code)
+            except (urllib.error.URLError, OSError) as e:
+                if attempt >= self.retries:
+                    raise
+                reason = str(e)
+
+            wait = self.backoff * 2 ** attempt * (1 + random.random() / 2)
+            logger.warning("Request failed ({0}), retrying in {1:.1f}s".format(reason, wait))
+            time.sleep(wait)
+            attempt += 1
+
+    def translateall(self, chunks, source, target):
+        """ Translate chunks (lists of texts), with up to
+        self.workers requests in flight. Yields (chunk, translations) as chunks finish,
+        with translations None for a chunk that failed for good. """
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append((chunk, pool.submit(self.translatebatch, chunk, source, target)))
+                if len(pending) >= 2 * self.workers:
+                    yield self.result(*pending.popleft())
+            while len(pending) > 0:
+                yield self.result(*pending.popleft())
+
+    def result(self, chunk, future):
+        try:
+            return chunk, future.result()
+        except Exception as e:
+            logger.error("Failed to translate a chunk of {0}: {1}".format(len(chunk), e))
+            return chunk, None
+
+
+def chunkbycount(texts, size):
+    """ Non-overlapping chunks of at most size texts """
+    return [texts[i:i+size] for i in range(0, len(texts), size)]
+
+
+def chunkbychars(texts, maxchars, maxcount):
+    """ Non-overlapping chunks of texts, each with at most maxcount texts and (unless
+    a single text is longer) at most maxchars characters in total """
+    chunks = []
+    chunk = []
+    chars = 0
+    for text in texts:
+        if len(chunk) > 0 and (len(chunk) >= maxcount or chars + len(text) > maxchars):
+            chunks.append(chunk)
+            chunk = []
+            chars = 0
+        chunk.append(text)
+        chars += len(text)
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
@@ -0,0 +1,97 @@
+#  -*- coding: utf-8 -*-
+""" A key-value table in SQLite, shared by the translation memory (transmem.py)
+and the API translation cache (transcache.py).
+
+The database is in WAL mode, so readers never block and several processes can
+write to it without corrupting it. Keys are tuples of text columns and values
+are text. Puts are buffered and written in batches, and gets see the buffer.
+"""
+import os
+import sqlite3
+
+# puts are written to the database in batches of this many
+BATCHSIZE = 1000
+
+# keys per SELECT (sqlite limits the number of parameters in a statement)
+QUERYSIZE = 500
+
+
+class KVStore:
+
+    def __init__(self, fname, table, keycols, valuecol="value", batchsize=BATCHSIZE):
+        """ The table is created (with keycols as its primary key) if it isn't there. """
+        self.fname = fname
+        self.table = table
+        self.keycols = list(keycols)
+        self.valuecol = valuecol
+        self.batchsize = batchsize
+
+        dirname = os.path.dirname(fname)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        self.db = sqlite3.connect(fname, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        cols = ", ".join(c + " TEXT NOT NULL" for c in self.keycols + [valuecol])
+        self.db.execute("CREATE TABLE IF NOT EXISTS {0} ({1}, PRIMARY KEY ({2})) WITHOUT ROWID".format(
+            table, cols, ", ".join(self.keycols)))
+        self.db.commit()
+
+        # key tuple -> value, not yet written
+        self.pending = {}
+
+    def get(self, key):
+        """ The value of a key tuple, or None """
+        if key in self.pending:
+            return self.pending[key]
+        cur = self.db.execute("SELECT {0} FROM {1} WHERE {2}".format(
+            self.valuecol, self.table, " AND ".join(c + " = ?" for c in self.keycols)), key)
+        row = cur.fetchone()
+        return None if row is None else row[0]
+
+    def get_many(self, prefix, lasts):
+        """ A dict of last -> value, for the keys prefix + (last,) that are in the store """
+        prefix = tuple(prefix)
+        found = {}
+        rest = []
+        for last in dict.fromkeys(lasts):
+            key = prefix + (last,)
+            if key in self.pending:
+                found[last] = self.pending[key]
+            else:
+                rest.append(last)
+
+        where = " AND ".join(c + " = ?" for c in self.keycols[:-1])
+        for i in range(0, len(rest), QUERYSIZE):
+            chunk = rest[i:i+QUERYSIZE]
+            cur = self.db.execute("SELECT {0}, {1} FROM {2} WHERE {3}{4} IN ({5})".format(
+                self.keycols[-1], self.valuecol, self.table, where + " AND " if where else "",
+                self.keycols[-1], ",".join("?" * len(chunk))), list(prefix) + chunk)
+            found.update(cur.fetchall())
+        return found
+
+    def put(self, key, value):
+        self.pending[key] = value
+        if len(self.pending) >= self.batchsize:
+            self.flush()
+
+    def put_many(self, items):
+        """ Add (key, value) pairs """
+        for key, value in items:
+            self.pending[key] = value
+        if len(self.pending) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO {0} ({1}, {2}) VALUES ({3})".format(
+                self.table, ", ".join(self.keycols), self.valuecol, ",".join("?" * (len(self.keycols) + 1))),
+                [key + (value,) for key, value in self.pending.items()])
+        self.pending = {}
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,315 @@
+#  -*- coding: utf-8 -*-
+""" Compact and compiled binary lexicons.
+
+A CompactLexicon holds the normalized source->target mapping produced by
+lexicons.getlexiconmapping in a few flat arrays instead of a dict of dicts:
+every distinct string is stored once (interned), and each source phrase has a
+run of target ids and float32 scores, sorted by score.
+
+The same bytes can be written to a file and memory-mapped (CompiledLexicon).
+Nothing is parsed at load time, so startup is near-instant, and since the file
+is mapped read-only its pages are shared by every process that opens it.
+
+Layout (little-endian, every section 8-byte aligned):
+
+    header    magic, version, counts and the length of the metadata blob
+    meta      utf-8 json: the source lexicon files this was compiled from, and how
+    stroffs   uint64[nstrings+1]  offsets into the string blob
+    blob      utf-8 bytes of every distinct source and target string
+    keys      uint32[nkeys]       string id of each source phrase
+    entoffs   uint32[nkeys+1]     offsets into targets/scores
+    targets   uint32[nentries]    string id of each translation
+    scores    float32[nentries]   normalized score of each translation
+    table     int32[tablesize]    open-addressing hash table of key ids
+"""
+import json
+import mmap
+import os
+import struct
+import zlib
+from array import array
+
+from utils import logger, atomicwrite, newerthan
+
+MAGIC = b"CTLEXBIN"
+VERSION = 2
+
+HEADER = struct.Struct("<8sIIQQQQ")
+
+
+def _hash(bs):
+    return zlib.crc32(bs)
+
+
+def _pad(n):
+    return (8 - n % 8) % 8
+
+
+def _tablesize(nkeys):
+    size = 8
+    while size < 2 * nkeys:
+        size *= 2
+    return size
+
+
+def serialize(dct, sources=(), params=None):
+    """ Pack a mapping of source -> {target: score} into the compact layout.
+    sources is a list of the lexicon files dct was built from, and params a json-able
+    description of how (e.g. the pruning), these are recorded so that a compiled file
+    can be checked for staleness. """
+    if isinstance(dct, CompactLexicon) and len(dct.extra) == 0:
+        # already in the layout (e.g. from lexicons.pivot), so only the metadata changes
+        return pack(dct.stroffs, dct.blob, dct.keyids, dct.entoffs, dct.targets, dct.scores, sources, params,
+                    dct.table)
+
+    strids = {}
+    strings = []
+
+    def intern(s):
+        if s not in strids:
+            strids[s] = len(strings)
+            strings.append(s.encode("utf8"))
+        return strids[s]
+
+    keys = array("I")
+    entoffs = array("I", [0])
+    targets = array("I")
+    scores = array("f")
+
+    for k in dct:
+        keys.append(intern(k))
+        # sorted by increasing score. The sort is stable, so ties keep the order
+        # of the mapping (translate breaks ties with it).
+        for t, score in sorted(dict(dct[k]).items(), key=lambda p: p[1]):
+            targets.append(intern(t))
+            scores.append(score)
+        entoffs.append(len(targets))
+
+    stroffs = array("Q", [0])
+    for bs in strings:
+        stroffs.append(stroffs[-1] + len(bs))
+
+    return pack(stroffs, b"".join(strings), keys, entoffs, targets, scores, sources, params)
+
+
+def pack(stroffs, blob, keys, entoffs, targets, scores, sources=(), params=None, table=None):
+    """ The compact layout of these arrays (see the top of this file, anything with the
+    buffer protocol and the item type of its section will do). The entries of each key
+    must be sorted by increasing score. The hash table is built unless it is given. """
+    stroffs = memoryview(stroffs).cast("B").cast("Q")
+    keys = memoryview(keys).cast("B").cast("I")
+
+    if table is None:
+        size = _tablesize(len(keys))
+        table = array("i", [-1]) * size
+        for kid, sid in enumerate(keys.tolist()):
+            slot = _hash(blob[stroffs[sid]:stroffs[sid + 1]]) & (size - 1)
+            while table[slot] != -1:
+                slot = (slot + 1) & (size - 1)
+            table[slot] = kid
+
+    meta = {"sources": [os.path.abspath(s) for s in sources]}
+    if params is not None:
+        meta["params"] = params
+    meta = json.dumps(meta).encode("utf8")
+
+    sections = [memoryview(x).cast("B") for x in [meta, stroffs, blob, keys, entoffs, targets, scores, table]]
+    buf = bytearray(HEADER.pack(MAGIC, VERSION, len(meta), len(stroffs) - 1, len(keys),
+                                sections[5].nbytes // 4, sections[7].nbytes // 4))
+    for section in sections:
+        buf += section
+        buf += b"\0" * _pad(len(section))
+    return buf
+
+
+def writelexicon(dct, fname, sources=(), params=None):
+    """ Write a mapping of source -> {target: score} to fname as a compiled lexicon. """
+    buf = serialize(dct, sources, params)
+
+    dirname = os.path.dirname(fname)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+
+    # concurrent readers never see a partial file.
+    with atomicwrite(fname, "wb") as out:
+        out.write(buf)
+
+    logger.info("Wrote compiled lexicon {0} ({1} bytes)".format(fname, len(buf)))
+
+
+def readheader(fname):
+    """ Returns (version, metadata) of a compiled lexicon, or None if it is not one. """
+    try:
+        with open(fname, "rb") as f:
+            head = f.read(HEADER.size)
+            if len(head) < HEADER.size:
+                return None
+            magic, version, metalen = HEADER.unpack(head)[:3]
+            if magic != MAGIC:
+                return None
+            meta = json.loads(f.read(metalen).decode("utf8"))
+    except (IOError, ValueError):
+        return None
+    return version, meta
+
+
+def isfresh(fname, sources, params=None):
+    """ True if fname is a compiled lexicon of the current version, built from
+    exactly these sources with these params, and newer than all of them. """
+    if not os.path.exists(fname):
+        return False
+    header = readheader(fname)
+    if header is None:
+        return False
+    version, meta = header
+    if version != VERSION:
+        return False
+    if meta.get("sources") != [os.path.abspath(s) for s in sources]:
+        return False
+    if meta.get("params") != params:
+        return False
+    return newerthan([fname], sources)
+
+
+class CompactLexicon:
+    """ Read-only view of a lexicon in the compact layout. It supports the dict
+    operations that Translator uses: `k in lex`, `lex[k]` (a dict of target -> score),
+    len() and iteration over the source phrases. """
+
+    def __init__(self, buf):
+        buf = memoryview(buf)
+        magic, version, metalen, nstrings, nkeys, nentries, size = HEADER.unpack_from(buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a version {0} compact lexicon".format(VERSION))
+
+        pos = HEADER.size
+
+        def section(nbytes):
+            nonlocal pos
+            sec = buf[pos:pos + nbytes]
+            pos += nbytes + _pad(nbytes)
+            return sec
+
+        self.meta = json.loads(bytes(section(metalen)).decode("utf8"))
+        self.stroffs = section(8 * (nstrings + 1)).cast("Q")
+        self.blob = section(self.stroffs[-1])
+        self.keyids = section(4 * nkeys).cast("I")
+        self.entoffs = section(4 * (nkeys + 1)).cast("I")
+        self.targets = section(4 * nentries).cast("I")
+        self.scores = section(4 * nentries).cast("f")
+        self.table = section(4 * size).cast("i")
+        self.mask = size - 1
+
+        # entries added at runtime (e.g. from taglists) live here, the arrays are read-only.
+        self.extra = {}
+
+    @classmethod
+    def frommapping(cls, dct):
+        """ Build a compact copy of a dict of dicts (after which dct can be dropped) """
+        return cls(serialize(dct))
+
+    def string(self, sid):
+        return bytes(self.blob[self.stroffs[sid]:self.stroffs[sid + 1]]).decode("utf8")
+
+    def find(self, key):
+        """ Returns the key id of key, or -1 """
+        bs = key.encode("utf8")
+        slot = _hash(bs) & self.mask
+        while True:
+            kid = self.table[slot]
+            if kid == -1:
+                return -1
+            sid = self.keyids[kid]
+            if self.blob[self.stroffs[sid]:self.stroffs[sid + 1]] == bs:
+                return kid
+            slot = (slot + 1) & self.mask
+
+    def __contains__(self, key):
+        return key in self.extra or self.find(key) != -1
+
+    def __getitem__(self, key):
+        if key in self.extra:
+            return self.extra[key]
+        kid = self.find(key)
+        if kid == -1:
+            raise KeyError(key)
+        return {self.string(self.targets[e]): self.scores[e]
+                for e in range(self.entoffs[kid], self.entoffs[kid + 1])}
+
+    def __setitem__(self, key, value):
+        self.extra[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return len(self.keyids) + sum(1 for k in self.extra if self.find(k) == -1)
+
+    def __iter__(self):
+        for sid in self.keyids:
+            yield self.string(sid)
+        for k in self.extra:
+            if self.find(k) == -1:
+                yield k
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for k in self:
+            yield k, self[k]
+
+
+class MappedVocab:
+    """ A word -> id mapping over the keys of a compact lexicon written with the
+    words in id order (ids start at start). Processes that map the same file share
+    it, instead of each holding (and copying on write) a dict. """
+
+    def __init__(self, lex, start=0):
+        self.lex = lex
+        self.start = start
+
+    @classmethod
+    def fromwords(cls, words, start=0):
+        return cls(CompactLexicon.frommapping({w: {} for w in words}), start)
+
+    def get(self, word, default=None):
+        kid = self.lex.find(word)
+        return default if kid == -1 else kid + self.start
+
+    def __getitem__(self, word):
+        kid = self.lex.find(word)
+        if kid == -1:
+            raise KeyError(word)
+        return kid + self.start
+
+    def __contains__(self, word):
+        return self.lex.find(word) != -1
+
+    def __len__(self):
+        return len(self.lex.keyids)
+
+    def word(self, i):
+        """ The word with id i """
+        return self.lex.string(self.lex.keyids[i - self.start])
+
+    def __iter__(self):
+        """ The words, in id order """
+        for sid in self.lex.keyids:
+            yield self.lex.string(sid)
+
+
+class CompiledLexicon(CompactLexicon):
+    """ A compact lexicon memory-mapped from a file written by writelexicon """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            CompactLexicon.__init__(self, self.mm)
+        except ValueError:
+            raise ValueError("Not a version {0} compiled lexicon: {1}".format(VERSION, fname))
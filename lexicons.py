@@ -3,6 +3,16 @@ from collections import defaultdict
 from itertools import product
 import gzip
 import codecs
+import os
+import time
+from sys import intern
+import lexcache
+
+# source rows per block of the sparse pivot product
+PIVOTBLOCK = 10000
+
+# how often readlexicon logs its progress
+LOGROWS = 1000000
 
 
 def dictname(target):
@@ -17,55 +27,83 @@ def dictname(target):
         return LEXICONPATH + "/dict.{}".format(target)
 
 
+def openlexicon(fname):
+    """ Opens a lexicon file for reading text, gzipped or not """
+    if fname.endswith(".gz"):
+        return gzip.open(fname, "rt", encoding="utf8")
+    return open(fname, "r", encoding="utf8")
+
+
+def iterlexicon(fname):
+    """ Lazily yields the (e, f) pairs of a lexicon file, one row at a time """
+    with openlexicon(fname) as lex:
+        for line in lex:
+            sline = line.strip().split("\t")
+
+            if USEMASTERLEX:
+                yield sline[5], sline[0]
+
+            elif USEPAVLICK:
+                # some lines have multiple definitions in them.
+                # each one is a pair.
+                for eng in sline[1:]:
+                    eng = eng.rstrip()
+                    if eng != "":
+                        yield eng, sline[0]
+
+
+def maxrss():
+    """ Peak resident memory of this process in MB, or nan if we can't tell """
+    try:
+        import resource
+    except ImportError:
+        return float("nan")
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
 def readlexicon(fname):
-    """ Reads files from Katrin Kirchhoff/Mark H-J lexicons
+    """ Reads files from Katrin Kirchhoff/Mark H-J lexicons. The file is
+    streamed, and the count tables are filled in a single pass.
     """
     f2e = defaultdict(set)
     e2f = defaultdict(set)
+    pairs = defaultdict(int)
 
     logger.info("Reading " + fname)
-    if USEMASTERLEX:
-        with gzip.open(fname, "rb") as f:
-            lines = f.readlines()
-    elif USEPAVLICK:
-        with open(fname, "r") as f:
-            lines = f.readlines()
+    start = time.time()
+    rows = 0
 
-        # some lines have multiple definitions in them.
-        # expand these to multiple lines
-        newlines = []
-        for line in lines:
-            sline = line.strip().split("\t")
-            for eng in sline[1:]:
-                newlines.append(sline[0] + "\t" + eng)
-        lines = newlines
-
-    pairs = defaultdict(int)
-
-    for line in lines:
-        sline = line.strip().split("\t")
+    for e, f in iterlexicon(fname):
+        rows += 1
+        if rows % LOGROWS == 0:
+            logger.info("{0} rows, {1:.0f} rows/s".format(rows, rows / (time.time() - start)))
 
-        if USEMASTERLEX:
-            f = sline[0]
-            e = sline[5]
-        elif USEPAVLICK:
-            f = sline[0]
-            e = sline[1]
+        # intern everything, so the many copies of a word (and a lower cased
+        # word that equals the original) in pairs, e2f and f2e are one object.
+        e = intern(e)
+        f = intern(f)
+        el = intern(e.lower())
+        fl = intern(f.lower())
 
         pairs[(e, f)] += 1
-        pairs[(e.lower(), f.lower())] += 1
+        pairs[(el, fl)] += 1
         
         ewords = e.split()
         fwords = f.split()
         for ew, fw in product(ewords, fwords):
-            pairs[(ew, fw)] += 1
-            pairs[(ew.lower(), fw.lower())] += 1
+            pairs[(intern(ew), intern(fw))] += 1
+            pairs[(intern(ew.lower()), intern(fw.lower()))] += 1
 
         f2e[f].add(e)
-        f2e[f.lower()].add(e)
+        f2e[fl].add(e)
         
         e2f[e].add(f)
-        e2f[e.lower()].add(f)
+        e2f[el].add(f)
+
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info("Read {0} rows in {1:.1f}s ({2:.0f} rows/s), peak memory {3:.1f} MB".format(
+        rows, elapsed, rows / elapsed, maxrss()))
 
     logger.info("Num e keys: {0}.".format(len(e2f)))
     numentries = sum(map(len, list(e2f.values())))
@@ -75,28 +113,53 @@ def readlexicon(fname):
     return e2f, f2e, pairs
 
 
-def getlexiconmapping(source, target):
+def normalize(e2f, pairs):
+    """ Turns the counts from readlexicon into a mapping of e -> {f: score},
+    where the scores for each e sum to 1. """
     dct = defaultdict(lambda: defaultdict(float))
-    
-    if source == "eng":
-        e2f, f2e, pairs = readlexicon(dictname(target))
 
-        # normalize the dictionary with scores.
-        for k in list(e2f.keys()):
+    for k in list(e2f.keys()):
 
-            scores = [(w, pairs[(k,w)]) for w in e2f[k]]
+        scores = [(w, pairs[(k,w)]) for w in e2f[k]]
 
-            t1 = float(sum([p[1] for p in scores]))
-            t1 = max(0.1, t1)
-            nscores = sorted([(p[0], p[1] / t1) for p in scores], key=lambda p: p[1])
+        t1 = float(sum([p[1] for p in scores]))
+        t1 = max(0.1, t1)
+        nscores = sorted([(p[0], p[1] / t1) for p in scores], key=lambda p: p[1])
 
-            for p in nscores:
-                dct[k][p[0]] += p[1]
+        for p in nscores:
+            dct[k][p[0]] += p[1]
+
+    return dct
+
+
+def getlexnamemapping(lexname):
+    """ The mapping for a single special lexicon file (keys are the e side) """
+    e2f, f2e, pairs = readlexicon(lexname)
+    return normalize(e2f, pairs)
+
+
+def getlexiconmapping(source, target, topk=None, minprob=0.0, lexicons=None):
+    """ Returns the source -> {target: score} mapping, and the reverse (unnormalized)
+    mapping when one side is english. Other pairs are pivoted through english,
+    where topk and minprob prune the targets of each source (see pivot). lexicons
+    maps language codes to the readlexicon tables of any that are already read. """
+    dct = defaultdict(lambda: defaultdict(float))
+
+    def read(lang):
+        if lexicons is not None and lang in lexicons:
+            return lexicons[lang]
+        return readlexicon(dictname(lang))
+    
+    if source == "eng":
+        e2f, f2e, pairs = read(target)
+
+        # normalize the dictionary with scores.
+        dct = normalize(e2f, pairs)
             
         return dct, f2e
 
     if target == "eng":
-        e2f, f2e, pairs = readlexicon(dictname(source))
+        e2f, f2e, pairs = read(source)
         
         # normalize the dictionary with scores.
         for k in list(f2e.keys()):
@@ -112,8 +175,8 @@ def getlexiconmapping(source, target):
 
         return dct, e2f
     
-    l1dict, l1rev, pairs1 = readlexicon(dictname(source))
-    l2dict, l2rev, pairs2 = readlexicon(dictname(target))
+    l1dict, l1rev, pairs1 = read(source)
+    l2dict, l2rev, pairs2 = read(target)
 
     # these are all english keys
     l1set = set(l1dict.keys())
@@ -122,39 +185,296 @@ def getlexiconmapping(source, target):
     inter = l1set.intersection(l2set)
     print("Size of intersection:", len(inter))
 
-    for s in inter:
-        # l1dict[s] is a set. Just get scores for each element of the set. 
-        scores1 = [(w, pairs1[(s,w)]) for w in l1dict[s]]
-        scores2 = [(w, pairs2[(s,w)]) for w in l2dict[s]]
-        
-        t1 = float(sum([p[1] for p in scores1]))
-        t2 = float(sum([p[1] for p in scores2]))
-
-        # to avoid division by 0
-        t1 = max(0.1, t1)
-        t2 = max(0.1, t2)
-        
-        nscores1 = sorted([(p[0], p[1] / t1) for p in scores1], key=lambda p: p[1])
-        nscores2 = sorted([(p[0], p[1] / t2) for p in scores2], key=lambda p: p[1])
-
-        for p1,p2 in product(nscores1, nscores2):            
-            dct[p1[0]][p2[0]] += p1[1] * p2[1]
-
-    return dct, None
-
-
-def getFAfile(lang):
+    # l1dict[s] is a set. Just get scores for each element of the set. 
+    n1 = normalize({s: l1dict[s] for s in inter}, pairs1)
+    n2 = normalize({s: l2dict[s] for s in inter}, pairs2)
+
+    return pivot(n1, n2, topk, minprob), None
+
+
+def prune(row, topk=None, minprob=0.0):
+    """ Keeps the targets of one source with score >= minprob, and only the topk best
+    if topk is given. Returns (target, score) pairs sorted by increasing score. """
+    scores = sorted([p for p in row if p[1] >= minprob], key=lambda p: p[1])
+    if topk:
+        scores = scores[-topk:]
+    return scores
+
+
+def pivot(n1, n2, topk=None, minprob=0.0):
+    """ Combines normalized mappings eng -> source (n1) and eng -> target (n2)
+    into source -> target, where score(f1, f2) = sum over e of n1[e][f1] * n2[e][f2].
+
+    This is the sparse matrix product A B, with A the source x eng matrix and B the
+    eng x target matrix. It is computed a block of source rows at a time, and each
+    row is pruned to scores >= minprob and the topk best before the next block, so
+    sources with a huge fan-out don't blow up memory. The pruning works on the arrays
+    of each block, and the kept rows go straight into a CompactLexicon. Uses scipy if
+    it is there, and python loops (and a dict of dicts) otherwise. """
+    try:
+        import numpy as np
+        import scipy.sparse as sparse
+    except ImportError:
+        logger.warning("No scipy, pivoting with python loops.")
+        dct = defaultdict(lambda: defaultdict(float))
+        rows = defaultdict(lambda: defaultdict(float))
+        for s in n1:
+            for p1,p2 in product(n1[s].items(), n2[s].items()):            
+                rows[p1[0]][p2[0]] += p1[1] * p2[1]
+        for f1 in rows:
+            for f2, score in prune(rows[f1].items(), topk, minprob):
+                dct[f1][f2] = score
+        return dct
+
+    # number everything
+    engs = list(n1.keys())
+    srcs = sorted(set(f for e in engs for f in n1[e]))
+    tgts = sorted(set(f for e in engs for f in n2[e]))
+    srcids = {f: i for i, f in enumerate(srcs)}
+    tgtids = {f: i for i, f in enumerate(tgts)}
+
+    def matrix(n, ids, transpose):
+        rows, cols, data = [], [], []
+        for ei, e in enumerate(engs):
+            for f, score in n[e].items():
+                rows.append(ei)
+                cols.append(ids[f])
+                data.append(score)
+        m = sparse.csr_matrix((data, (rows, cols)), shape=(len(engs), len(ids)), dtype=np.float64)
+        return m.T.tocsr() if transpose else m
+
+    a = matrix(n1, srcids, True)
+    b = matrix(n2, tgtids, False)
+    logger.info("Pivoting {0} x {1} by {1} x {2}".format(a.shape[0], a.shape[1], b.shape[1]))
+
+    # the kept source rows, their number of targets, and the targets and scores
+    keys, counts, cols, data = [np.zeros(0, np.int64)], [np.zeros(0, np.int64)], [np.zeros(0, np.int32)], [np.zeros(0)]
+    for start in range(0, a.shape[0], PIVOTBLOCK):
+        block = a[start:start+PIVOTBLOCK].dot(b).tocsr()
+        rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+
+        # each row by increasing score. The sort is stable, so ties keep their order
+        # in the row, as with prune.
+        order = np.lexsort((block.data, rows))
+        rows, c, d = rows[order], block.indices[order], block.data[order]
+        keep = d >= minprob
+        rows, c, d = rows[keep], c[keep], d[keep]
+
+        n = np.bincount(rows, minlength=block.shape[0])
+        if topk:
+            # an entry is kept if fewer than topk entries of its row come after it
+            after = np.cumsum(n)[rows] - np.arange(len(rows)) - 1
+            keep = after < topk
+            rows, c, d = rows[keep], c[keep], d[keep]
+            n = np.bincount(rows, minlength=block.shape[0])
+
+        kept = np.flatnonzero(n)
+        keys.append(kept + start)
+        counts.append(n[kept])
+        cols.append(c)
+        data.append(d)
+
+    keys = np.concatenate(keys)
+    cols = np.concatenate(cols)
+
+    # the strings are the kept sources, then the targets that are used
+    used, targets = np.unique(cols, return_inverse=True)
+    strings = [srcs[k].encode("utf8") for k in keys.tolist()] + [tgts[t].encode("utf8") for t in used.tolist()]
+    stroffs = np.zeros(len(strings) + 1, dtype=np.uint64)
+    np.cumsum([len(bs) for bs in strings], out=stroffs[1:])
+    entoffs = np.zeros(len(keys) + 1, dtype=np.uint32)
+    np.cumsum(np.concatenate(counts), out=entoffs[1:])
+
+    return lexcache.CompactLexicon(lexcache.pack(
+        stroffs, b"".join(strings), np.arange(len(keys), dtype=np.uint32), entoffs,
+        (targets + len(keys)).astype(np.uint32), np.concatenate(data).astype(np.float32)))
+
+
+def lexiconsources(source, target, lexname=None):
+    """ The lexicon files that the source/target mapping is built from """
+    if lexname:
+        return [lexname]
+    if source == "eng":
+        return [dictname(target)]
+    if target == "eng":
+        return [dictname(source)]
+    return [dictname(source), dictname(target)]
+
+
+def pruning(source, target, lexname=None, topk=None, minprob=0.0):
+    """ The pruning (see pivot) that topk and minprob make to the source/target mapping,
+    as a dict, or None if they make none: only a mapping pivoted through english is pruned. """
+    if lexname or source == "eng" or target == "eng" or not (topk or minprob):
+        return None
+    return {"topk": topk, "minprob": minprob}
+
+
+def compiledname(source, target, lexname=None, topk=None, minprob=0.0):
+    """ Where the compiled version of the source/target mapping lives. A pruned mapping
+    has the pruning in its name, so it doesn't take the place of the unpruned one. """
+    if lexname:
+        return COMPILEDPATH + os.path.basename(lexname) + ".lex"
+    name = "{0}-{1}".format(source, target)
+    params = pruning(source, target, lexname, topk, minprob)
+    if params is not None:
+        if params["topk"]:
+            name += ".top{0}".format(params["topk"])
+        if params["minprob"]:
+            name += ".min{0:g}".format(params["minprob"])
+    return COMPILEDPATH + name + ".lex"
+
+
+def vecindexname(source, target, lexname=None, topk=None, minprob=0.0):
+    """ The prefix of the vector index (see vecindex.py) for the keys of the source/target mapping """
+    return compiledname(source, target, lexname, topk, minprob)[:-len(".lex")] + ".vecs"
+
+
+def compilemapping(source, target, lexname=None, topk=None, minprob=0.0):
+    """ Builds the source/target mapping and writes it as a compiled lexicon.
+    Returns the name of the compiled file. """
+    if lexname:
+        dct = getlexnamemapping(lexname)
+    else:
+        dct, _ = getlexiconmapping(source, target, topk, minprob)
+
+    fname = compiledname(source, target, lexname, topk, minprob)
+    lexcache.writelexicon(dct, fname, lexiconsources(source, target, lexname),
+                          pruning(source, target, lexname, topk, minprob))
+    return fname
+
+
+def loadcompiled(source, target, lexname=None, topk=None, minprob=0.0):
+    """ Returns the memory-mapped compiled mapping for source/target. It is
+    (re)compiled first if it is missing, of an old version, older than the lexicons
+    it was built from, or pruned differently. topk and minprob prune a pivoted
+    mapping (see pivot). """
+    fname = compiledname(source, target, lexname, topk, minprob)
+    params = pruning(source, target, lexname, topk, minprob)
+    if lexcache.isfresh(fname, lexiconsources(source, target, lexname), params):
+        logger.info("Using compiled lexicon " + fname)
+    else:
+        logger.info("Compiled lexicon {0} is missing or stale, compiling.".format(fname))
+        compilemapping(source, target, lexname, topk, minprob)
+    return lexcache.CompiledLexicon(fname)
+
+
+def trienames(source, target, lexname=None, topk=None, minprob=0.0):
+    """ Where the trie nodes and tokens of the compiled source/target mapping live (see loadmappedtrie) """
+    base = compiledname(source, target, lexname, topk, minprob)[:-len(".lex")]
+    return base + ".trie", base + ".tokens.lex"
+
+
+def loadmappedtrie(source, target, lexname=None, dct=None, topk=None, minprob=0.0):
+    """ Returns a MappedTrie over the compiled source/target mapping (dct, if it is
+    already open), (re)building its node and token files if they are missing or
+    older than the mapping. """
+    import phrasetrie
+
+    if dct is None:
+        dct = loadcompiled(source, target, lexname, topk, minprob)
+    fname = compiledname(source, target, lexname, topk, minprob)
+    nname, tname = trienames(source, target, lexname, topk, minprob)
+
+    if not (phrasetrie.isfresh(nname, [fname]) and lexcache.isfresh(tname, [fname])):
+        logger.info("Compiling the trie nodes and tokens of " + fname)
+        phrasetrie.writetrie(dct, nname, tname, [fname])
+
+    return phrasetrie.MappedTrie(nname, lexcache.CompiledLexicon(tname), dct)
+
+
+def writefafile(e2f, fname):
+    """ Writes the pairs of e2f (from readlexicon) as a fast_align training file,
+    one lower cased "eng ||| foreign" pair per line. Returns the number of lines. """
+    lines = sorted({(e.lower(), f.lower()) for e in e2f for f in e2f[e]})
+    with codecs.open(fname, "w", "utf8") as out:
+        for e, f in lines:
+            out.write(e + " ||| " + f + "\n")
+    return len(lines)
+
+
+def fafilename(lang):
+    return COMPILEDPATH + "text.eng-" + lang
+
+
+def getFAfile(lang, fname=None):
     """ This creates a file for fast_align training """
-    dct = readlexicon(dictname(lang))
-
-    out = codecs.open("text.eng-"+lang, "w", "utf8")
-    
-    for key in dct:
-        vals = dct[key]
-        for val in vals:
-            out.write(key.lower() + " ||| " + val.lower() + "\n")
-
-    out.close()
+    e2f, _, _ = readlexicon(dictname(lang))
+    writefafile(e2f, fname or "text.eng-" + lang)
+
+
+# the lexicons read by buildall, by language, for the build processes
+_lexicons = {}
+
+
+def _buildmapping(source, target, topk, minprob):
+    start = time.time()
+    dct, _ = getlexiconmapping(source, target, topk, minprob, _lexicons)
+    fname = compiledname(source, target, None, topk, minprob)
+    params = pruning(source, target, None, topk, minprob)
+    lexcache.writelexicon(dct, fname, lexiconsources(source, target), params)
+    return {"file": fname, "bytes": os.path.getsize(fname), "keys": len(dct), "pruning": params,
+            "seconds": time.time() - start}
+
+
+def _buildfafile(lang):
+    start = time.time()
+    fname = fafilename(lang)
+    lines = writefafile(_lexicons[lang][0], fname)
+    return {"file": fname, "bytes": os.path.getsize(fname), "lines": lines,
+            "seconds": time.time() - start}
+
+
+def buildall(sources, targets, topk=None, minprob=0.0, workers=None, manifest=None):
+    """ Compiles the mapping of every source/target pair (direct or pivoted), and
+    writes a fast_align file for every language read, under COMPILEDPATH.
+
+    Each lexicon is read once, here, and the builds then run in a pool of processes
+    forked with the lexicons in hand. Pivoted mappings are pruned with topk and minprob,
+    and a pruned mapping is written under its own name (see compiledname). A json
+    manifest of the files written, with their sizes, pruning and build times, goes to
+    manifest (COMPILEDPATH/manifest.json by default). Returns the manifest. """
+    import json
+    import forkpool
+
+    started = time.time()
+    pairs = [(s, t) for s in sources for t in targets if s != t]
+    langs = sorted({l for p in pairs for l in p if l != "eng"})
+
+    os.makedirs(COMPILEDPATH, exist_ok=True)
+    report = {"languages": {}, "mappings": {}, "fastalign": {}, "topk": topk, "minprob": minprob}
+    for lang in langs:
+        start = time.time()
+        _lexicons[lang] = readlexicon(dictname(lang))
+        report["languages"][lang] = {"file": dictname(lang), "bytes": os.path.getsize(dictname(lang)),
+                                     "seconds": time.time() - start}
+
+    if forkpool.canfork():
+        with forkpool.ForkPool(workers) as pool:
+            mappings = [(p, pool.submit(_buildmapping, p[0], p[1], topk, minprob)) for p in pairs]
+            fafiles = [(lang, pool.submit(_buildfafile, lang)) for lang in langs]
+            for (source, target), future in mappings:
+                report["mappings"]["{0}-{1}".format(source, target)] = future.result()
+                logger.info("Built {0}-{1}".format(source, target))
+            for lang, future in fafiles:
+                report["fastalign"][lang] = future.result()
+    else:
+        logger.warning("No fork, building serially.")
+        for source, target in pairs:
+            report["mappings"]["{0}-{1}".format(source, target)] = _buildmapping(source, target, topk, minprob)
+        for lang in langs:
+            report["fastalign"][lang] = _buildfafile(lang)
+    _lexicons.clear()
+
+    report["seconds"] = time.time() - started
+    report["peak_rss_mb"] = maxrss()
+    report["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    manifest = manifest or COMPILEDPATH + "manifest.json"
+    with atomicwrite(manifest) as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+    logger.info("Built {0} mappings and {1} fast_align files in {2:.1f}s, wrote {3}".format(
+        len(pairs), len(langs), report["seconds"], manifest))
+    return report
 
 
 if __name__ == "__main__":
@@ -163,7 +483,25 @@ if __name__ == "__main__":
 
     parser.add_argument("--source", "-s", help="Source language code (3 letter)")
     parser.add_argument("--target", "-t", help="Target language code (3 letter)")
+    parser.add_argument("--lexname", "-l", help="Name of special lexicon")
+    parser.add_argument("--compile", "-c", help="Write the mapping as a compiled lexicon", action="store_true")
+    parser.add_argument("--topk", help="When pivoting, keep this many targets per source", type=int)
+    parser.add_argument("--minprob", help="When pivoting, drop targets scored below this", type=float, default=0.0)
+    parser.add_argument("--build", help="Compile the mappings of all pairs of --sources and --targets, and write "
+                        "fast_align files and a manifest (see buildall)", action="store_true")
+    parser.add_argument("--sources", help="(with --build) Comma separated source language codes", default="eng")
+    parser.add_argument("--targets", help="(with --build) Comma separated target language codes")
+    parser.add_argument("--workers", "-w", help="(with --build) Number of processes to build with", type=int)
+    parser.add_argument("--manifest", help="(with --build) Where to write the manifest")
     
     args = parser.parse_args()
-        
-    dct, f2e = getlexiconmapping(args.source, args.target)
\ No newline at end of file
+
+    if args.build:
+        if not args.targets:
+            parser.error("--build needs --targets")
+        buildall(args.sources.split(","), args.targets.split(","), args.topk, args.minprob, args.workers,
+                 args.manifest)
+    elif args.compile:
+        compilemapping(args.source, args.target, args.lexname, args.topk, args.minprob)
+    else:
+        dct, f2e = getlexiconmapping(args.source, args.target, args.topk, args.minprob)
\ No newline at end of file
@@ -0,0 +1,53 @@
+#  -*- coding: utf-8 -*-
+from collections import OrderedDict, Counter
+from utils import logger
+
+# default number of scores to keep
+DEFAULTSIZE = 100000
+
+
+class LMCache:
+    """ Bounded LRU cache in front of a getNgramProb function. Scores are keyed by
+    (context tuple, word), so frequent words in frequent contexts are scored once. """
+
+    def __init__(self, scorefn, size=DEFAULTSIZE):
+        """ scorefn has the signature of srilm.getNgramProb. A size of 0 turns the
+        cache off (every call goes to scorefn). """
+        self.scorefn = scorefn
+        self.size = size
+        self.cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def score(self, lm, context, word):
+        """ The log probability of word following the list of words in context """
+        key = (tuple(context), word)
+        val = self.cache.get(key)
+        if val is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return val
+
+        self.misses += 1
+        val = self.scorefn(lm, " ".join(context + [word]), len(context)+1)
+
+        if self.size > 0:
+            self.cache[key] = val
+            if len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+        return val
+
+    def counts(self):
+        return Counter(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+def report(counts):
+    """ Logs hit/miss/eviction counts (as from LMCache.counts) """
+    calls = counts["hits"] + counts["misses"]
+    if calls == 0:
+        return
+    logger.info("LM cache: {0} hits, {1} misses, {2} evictions ({3:.1%} hit rate)".format(
+        counts["hits"], counts["misses"], counts["evictions"], counts["hits"] / float(calls)))
@@ -0,0 +1,170 @@
+#  -*- coding: utf-8 -*-
+""" Morphological expansion: candidate stems of a word that isn't in the lexicon.
+
+Each source language has a set of affix rules, (affix, replacement) pairs. A
+word ending in the suffix (or starting with the prefix) has it swapped for the
+replacement. The suffixes of a language are compiled into a trie over their
+reversed characters, so one walk back from the end of a word finds every
+suffix that matches it, however many rules there are. In languages with
+suffix chains (agglutinative ones, like Uzbek), stripping is repeated on the
+stems, and each stem is only expanded once.
+
+Variants come out in order of how much was removed (least first), and are
+memoized per word, for the MEMOSIZE most recently expanded words. The variants of a word don't depend on the lexicon, so
+they are found once per language (by the unfiltered expander) and each
+lexicon's expander only filters them against its tokens.
+"""
+from collections import OrderedDict
+
+from utils import logger
+
+RULES = {
+    "eng": dict(
+        suffixes=[("s", ""), ("es", ""), ("ies", "y"), ("'s", ""),
+                  ("ed", ""), ("d", ""), ("ied", "y"), ("ing", "")],
+        chains=False),
+    "uzb": dict(
+        suffixes=[("ning", ""), ("lik", ""), ("lar", ""), ("ish", ""), ("dan", ""),
+                  ("idan", ""), ("ini", ""), ("lari", ""), ("ga", ""), ("ni", "")],
+        chains=True,
+        rewrites=[("ʻ", "")]),
+}
+
+# a trie node key marking the rules that end there
+RULE = None
+
+# at most this many stripping rounds for chained suffixes
+MAXCHAIN = 6
+
+# the number of words (and of stems) whose variants an expander keeps
+MEMOSIZE = 100000
+
+
+def compilesuffixes(rules):
+    """ A trie over the reversed suffixes. Each node is a dict of character ->
+    child, and node[RULE] is a list of (suffix length, replacement) for the
+    suffixes that end at that node. """
+    root = {}
+    for suffix, repl in rules:
+        node = root
+        for c in reversed(suffix):
+            node = node.setdefault(c, {})
+        node.setdefault(RULE, []).append((len(suffix), repl))
+    return root
+
+
+def compileprefixes(rules):
+    root = {}
+    for prefix, repl in rules:
+        node = root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node.setdefault(RULE, []).append((len(prefix), repl))
+    return root
+
+
+class MorphExpander:
+
+    def __init__(self, suffixes=(), prefixes=(), chains=False, rewrites=(), tokens=None, base=None):
+        """ tokens, if given, is the set of words that a variant must be in to be kept
+        (the tokens of the lexicon keys). base is an unfiltered expander to take the
+        variants from, instead of the rules. """
+        self.suffixes = compilesuffixes(suffixes)
+        self.prefixes = compileprefixes(prefixes)
+        self.chains = chains
+        self.rewrites = list(rewrites)
+        self.tokens = tokens
+        self.base = base
+        # both are LRU caches (see remember)
+        self.memo = OrderedDict()
+        self.stems = OrderedDict()
+
+    def strip(self, w):
+        """ The stems of w with one affix removed, found in a single walk each way """
+        out = []
+        node = self.suffixes
+        for i in range(len(w) - 1, 0, -1):
+            node = node.get(w[i])
+            if node is None:
+                break
+            for n, repl in node.get(RULE, ()):
+                out.append((n - len(repl), w[:-n] + repl))
+
+        node = self.prefixes
+        for i in range(len(w) - 1):
+            node = node.get(w[i])
+            if node is None:
+                break
+            for n, repl in node.get(RULE, ()):
+                out.append((n - len(repl), repl + w[n:]))
+        return out
+
+    def allstems(self, w, depth=0):
+        """ Every (removed, stem) reachable from w, following chains if the language has them """
+        out = self.stems.get(w)
+        if out is not None:
+            self.stems.move_to_end(w)
+            return out
+        out = []
+        for removed, stem in self.strip(w):
+            out.append((removed, stem))
+            if self.chains and depth < MAXCHAIN:
+                out.extend((removed + r, s) for r, s in self.allstems(stem, depth + 1))
+        if self.chains:
+            # shared by every word that ends in the same chain.
+            remember(self.stems, w, out)
+        return out
+
+    def expand(self, w):
+        """ The variants of w, least changed first """
+        out = self.memo.get(w)
+        if out is not None:
+            self.memo.move_to_end(w)
+            return out
+
+        if self.base is not None:
+            out = [v for v in self.base.expand(w) if self.tokens is None or v in self.tokens]
+            remember(self.memo, w, out)
+            return out
+
+        cands = [(0, w)] + sorted(self.allstems(w), key=lambda p: p[0])
+        seen = {w}
+        out = []
+        for _, stem in cands:
+            for v in [stem] + [stem.replace(a, b) for a, b in self.rewrites if a in stem]:
+                if v not in seen and v != "" and (self.tokens is None or v in self.tokens):
+                    seen.add(v)
+                    out.append(v)
+
+        remember(self.memo, w, out)
+        return out
+
+
+def remember(cache, key, val):
+    """ Puts key in the OrderedDict cache, dropping the least recently used key if
+    that makes it hold more than MEMOSIZE """
+    cache[key] = val
+    if len(cache) > MEMOSIZE:
+        cache.popitem(last=False)
+
+
+def expander(lang, tokens=None):
+    """ The MorphExpander for a (3 letter) language code. Languages without rules
+    of their own get the English rules (which is what every source language used
+    to get). With tokens, the expander filters the variants of the (shared)
+    unfiltered expander of the language. """
+    if tokens is not None:
+        return MorphExpander(tokens=tokens, base=expander(lang))
+    if lang in _unfiltered:
+        return _unfiltered[lang]
+    if lang not in RULES:
+        logger.info("No morphological rules for {0}, expanding with the English rules".format(lang))
+        exp = MorphExpander(**RULES["eng"])
+    else:
+        exp = MorphExpander(**RULES[lang])
+    _unfiltered[lang] = exp
+    return exp
+
+
+# expanders without a token filter, by language
+_unfiltered = {}
@@ -0,0 +1,255 @@
+#  -*- coding: utf-8 -*-
+""" Token-level prefix trie over the keys of a lexicon, used to find the
+longest phrase at a position without joining and probing every window length. """
+import functools
+import json
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+
+import lexcache
+from utils import atomicwrite, newerthan
+
+# marks a node as the end of a key
+END = None
+
+# a node that only ends a key. Shared by all such nodes, and copied
+# before anything is added under it.
+LEAF = {END: True}
+
+# the mapped trie file (see writetrie)
+MAGIC = b"PHRTRIE\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQ")
+
+# how many token ids a MappedTrie keeps at hand
+TOKENCACHE = 1 << 16
+
+
+class PhraseTrie:
+    """ Each node is a dict of token -> child node. Keys are split on single
+    spaces, the same way translate joins window tokens into a phrase. """
+
+    def __init__(self, keys=()):
+        self.root = {}
+        self.size = 0
+        # every token that appears in a key
+        self.tokens = set()
+        for k in keys:
+            self.add(k)
+
+    def add(self, key):
+        toks = key.split(" ")
+        self.tokens.update(toks)
+        node = self.root
+        for t in toks[:-1]:
+            child = node.get(t)
+            if child is None:
+                child = {}
+                node[t] = child
+            elif child is LEAF:
+                child = dict(LEAF)
+                node[t] = child
+            node = child
+
+        last = toks[-1]
+        child = node.get(last)
+        if child is None:
+            node[last] = LEAF
+            self.size += 1
+        elif END not in child:
+            child[END] = True
+            self.size += 1
+
+    def path(self, tokens):
+        """ Walks tokens from the root. Returns the list of nodes visited, starting
+        with the root, and stopping as soon as no key continues the prefix. So
+        path[n] exists iff tokens[:n] is a prefix of some key. """
+        node = self.root
+        nodes = [node]
+        for t in tokens:
+            node = node.get(t)
+            if node is None:
+                break
+            nodes.append(node)
+        return nodes
+
+    def __contains__(self, key):
+        toks = key.split(" ")
+        nodes = self.path(toks)
+        return len(nodes) > len(toks) and END in nodes[-1]
+
+    def __len__(self):
+        return self.size
+
+
+def isend(path, n):
+    """ True iff the tokens that produced path, cut to length n, are a key """
+    return len(path) > n and END in path[n]
+
+
+class MappedNode:
+    """ A node of a MappedTrie: its id in the mapped nodes (-1 if it is not there)
+    and the PhraseTrie node of the runtime keys (None if it is not there). It answers
+    the same `node.get(token)` and `END in node` as a PhraseTrie node. """
+
+    __slots__ = ["trie", "nid", "extra"]
+
+    def __init__(self, trie, nid, extra):
+        self.trie = trie
+        self.nid = nid
+        self.extra = extra
+
+    def get(self, token, default=None):
+        nid = self.trie.child(self.nid, token) if self.nid != -1 else -1
+        extra = self.extra.get(token) if self.extra is not None else None
+        if nid == -1 and extra is None:
+            return default
+        return MappedNode(self.trie, nid, extra)
+
+    def __contains__(self, k):
+        if k is not END:
+            return False
+        if self.nid != -1 and self.trie.ends[self.nid]:
+            return True
+        return self.extra is not None and END in self.extra
+
+
+class MappedTrie:
+    """ A PhraseTrie that lives in a memory-mapped file (see writetrie) instead of
+    Python dicts, so every process that opens it shares one copy. Nodes are numbered
+    and the children of each node are sorted by token id, so a step down the trie is
+    a token id lookup and a binary search over integers. tokens is the compiled
+    lexicon of the key tokens, whose key ids are the token ids. keys is the lexicon itself. """
+
+    def __init__(self, fname, tokens, keys):
+        self.fname = fname
+        self.tokens = tokens
+        self.keys = keys
+        with open(fname, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self.mm)
+        magic, version, metalen, nnodes, nedges = HEADER.unpack_from(buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a version {0} phrase trie: {1}".format(VERSION, fname))
+
+        pos = HEADER.size + metalen + _pad(metalen)
+        self.childoffs = buf[pos:pos + 4 * (nnodes + 1)].cast("I")
+        pos += 4 * (nnodes + 1)
+        self.childtoks = buf[pos:pos + 4 * nedges].cast("I")
+        pos += 4 * nedges
+        self.childids = buf[pos:pos + 4 * nedges].cast("I")
+        pos += 4 * nedges
+        self.ends = buf[pos:pos + nnodes]
+
+        # the same few tokens are looked up over and over within a sentence
+        self.tokenid = functools.lru_cache(maxsize=TOKENCACHE)(tokens.find)
+
+        # keys added at runtime (e.g. from taglists), the mapped file is read-only.
+        self.extra = PhraseTrie()
+        self.root = MappedNode(self, 0, self.extra.root)
+
+    def child(self, nid, token):
+        """ The id of the child of node nid along token, or -1 """
+        tid = self.tokenid(token)
+        if tid == -1:
+            return -1
+        lo, hi = self.childoffs[nid], self.childoffs[nid + 1]
+        i = bisect_left(self.childtoks, tid, lo, hi)
+        if i < hi and self.childtoks[i] == tid:
+            return self.childids[i]
+        return -1
+
+    def add(self, key):
+        self.extra.add(key)
+
+    def path(self, tokens):
+        """ As PhraseTrie.path """
+        node = self.root
+        nodes = [node]
+        for t in tokens:
+            node = node.get(t)
+            if node is None:
+                break
+            nodes.append(node)
+        return nodes
+
+    def __contains__(self, key):
+        return key in self.keys or key in self.extra
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def _pad(n):
+    return (8 - n % 8) % 8
+
+
+def isfresh(fname, sources):
+    """ True if fname is a phrase trie of the current version, built from exactly
+    these sources, and newer than all of them. """
+    try:
+        with open(fname, "rb") as f:
+            head = f.read(HEADER.size)
+            if len(head) < HEADER.size:
+                return False
+            magic, version, metalen = HEADER.unpack(head)[:3]
+            if magic != MAGIC or version != VERSION:
+                return False
+            meta = json.loads(f.read(metalen).decode("utf8"))
+    except (IOError, ValueError):
+        return False
+    if meta.get("sources") != [os.path.abspath(s) for s in sources]:
+        return False
+    return newerthan([fname], sources)
+
+
+def writetrie(keys, fname, tname, sources=()):
+    """ Writes the trie of keys to fname, and its tokens as a compiled lexicon to tname,
+    for MappedTrie. Nodes are numbered breadth first from the root (0).
+
+    Layout (little-endian):
+
+        header     magic, version, length of the metadata blob, node and edge counts
+        meta       utf-8 json: the files this was built from
+        childoffs  uint32[nnodes+1]  offsets of the children of each node into childtoks/childids
+        childtoks  uint32[nedges]    token id of each child, sorted within a node
+        childids   uint32[nedges]    node id of each child
+        ends       uint8[nnodes]     1 if the node ends a key
+    """
+    trie = PhraseTrie()
+    tokens = {}
+    for k in keys:
+        trie.add(k)
+        for t in k.split(" "):
+            tokens[t] = {}
+    # the key ids of the token lexicon follow insertion order
+    tokenids = {t: i for i, t in enumerate(tokens)}
+    lexcache.writelexicon(tokens, tname, sources)
+
+    childoffs = array("I", [0])
+    childtoks = array("I")
+    childids = array("I")
+    ends = bytearray()
+    nodes = [trie.root]
+    i = 0
+    while i < len(nodes):
+        node = nodes[i]
+        ends.append(1 if END in node else 0)
+        for tid, child in sorted((tokenids[t], child) for t, child in node.items() if t is not END):
+            childtoks.append(tid)
+            childids.append(len(nodes))
+            nodes.append(child)
+        childoffs.append(len(childtoks))
+        i += 1
+
+    meta = json.dumps({"sources": [os.path.abspath(s) for s in sources]}).encode("utf8")
+    with atomicwrite(fname, "wb") as out:
+        out.write(HEADER.pack(MAGIC, VERSION, len(meta), len(nodes), len(childtoks)))
+        out.write(meta + bytes(_pad(len(meta))))
+        out.write(childoffs.tobytes())
+        out.write(childtoks.tobytes())
+        out.write(childids.tobytes())
+        out.write(bytes(ends))
@@ -0,0 +1,183 @@
+#  -*- coding: utf-8 -*-
+""" Per-stage timers and counters for a translation run (translate.py --profile).
+
+Profiler.instrument wraps the methods of each stage of Translator (loading
+the lexicon and LM, phrase lookup, expansion, LM scoring, translation memory
+lookups, output) with timers, so nothing is measured, and nothing costs
+anything, unless profiling is on.
+Each stage records its number of calls, its total time, and its own time
+(the total minus the time spent in other timed stages it called).
+
+The report is json:
+
+    stages      calls, seconds and self_seconds of each stage
+    tokens      source tokens translated (translation memory hits included), and tokens per second
+    lookup      tries, hits and hit rate of lexicon lookups by phrase length
+    lm          LM queries and actual LM calls (cache misses), per token
+    peak_rss_mb the peak resident memory of the process
+
+With cprofile, a cProfile of the whole run is also written (as pstats), and
+with tracemalloc the report lists the lines that allocated the most memory.
+
+Only the calling process is instrumented, so with --workers the stages that
+run in the worker processes are not in the report.
+"""
+import functools
+import json
+import time
+from collections import Counter, defaultdict
+
+from utils import logger, atomicwrite
+
+# how many allocation sites to list with tracemalloc
+TOPALLOCS = 25
+
+
+class Profiler:
+
+    def __init__(self, cprofile=None, tracemalloc=False):
+        """ cprofile is a file to write a cProfile of the run to. tracemalloc turns
+        on allocation tracing (which slows everything down considerably). """
+        self.seconds = defaultdict(float)
+        self.own = defaultdict(float)
+        self.calls = Counter()
+        # time spent in timed callees, for each timed call in progress
+        self.stack = []
+
+        self.tokens = 0
+        self.lookups = defaultdict(Counter)
+
+        self.cprofilename = cprofile
+        self.cprofile = None
+        self.tracemalloc = tracemalloc
+        self.started = time.perf_counter()
+
+    def start(self):
+        if self.tracemalloc:
+            import tracemalloc
+            tracemalloc.start()
+        if self.cprofilename:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.started = time.perf_counter()
+
+    def stop(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofilename)
+            logger.info("Wrote cProfile to " + self.cprofilename)
+
+    def add(self, stage, elapsed):
+        child = self.stack.pop()
+        self.seconds[stage] += elapsed
+        self.own[stage] += elapsed - child
+        self.calls[stage] += 1
+        if len(self.stack) > 0:
+            self.stack[-1] += elapsed
+
+    def timed(self, stage, fn, after=None):
+        """ fn, wrapped to be timed as stage. after(result, args) is called with each result. """
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            self.stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+            if after is not None:
+                after(result, args)
+            return result
+        return wrapper
+
+    def wrap(self, owner, name, stage=None, after=None):
+        setattr(owner, name, self.timed(stage or name, getattr(owner, name), after))
+
+    def instrument(self, translate):
+        """ Time the stages of every Translator made from now on, and start the run.
+        translate is the translate module (__main__ when translate.py is run). """
+        import lmcache
+
+        def countlookup(result, args):
+            # args are (self, words, lowers, path, lowpath, jj)
+            c = self.lookups[args[5]]
+            c["tries"] += 1
+            c["hits"] += result is not None
+
+        def counted(fn):
+            # translate_sentences is a generator, so its sentences are counted as they go by
+            @functools.wraps(fn)
+            def wrapper(tt, sentences, *args, **kwargs):
+                return fn(tt, self.counttokens(sentences), *args, **kwargs)
+            return wrapper
+
+        T = translate.Translator
+        self.wrap(T, "load_dictionary", "load_lexicon")
+        self.wrap(T, "load_lm")
+        self.wrap(T, "load_vecs")
+        self.wrap(T, "prepass")
+        T.translate_sentences = counted(T.translate_sentences)
+        self.wrap(T, "translate_sentence", "translate")
+        self.wrap(T, "translate_remembered", "remembered")
+        self.wrap(T, "lookup", after=countlookup)
+        self.wrap(T, "expand")
+        self.wrap(T, "vecsub")
+        self.wrap(T, "outputrows", "output")
+        self.wrap(lmcache.LMCache, "score", "lm")
+        self.wrap(translate, "writeconll", "write")
+        self.wrap(translate, "writeplaintext", "write")
+        self.wrap(translate, "writechunk", "write")
+
+        self.start()
+
+    def counttokens(self, sentences):
+        for sent, boundary in sentences:
+            self.tokens += len(sent)
+            yield sent, boundary
+
+    def report(self, translator=None):
+        """ The report as a json-able dict. translator gives the LM cache counts. """
+        wall = time.perf_counter() - self.started
+        # a sentence found in the translation memory is translated in its own time
+        translating = (self.seconds["translate"] + self.own["remembered"]) or wall
+
+        rep = {"wall_seconds": wall}
+        rep["stages"] = {s: {"calls": self.calls[s], "seconds": self.seconds[s], "self_seconds": self.own[s]}
+                         for s in sorted(self.seconds)}
+        rep["tokens"] = {"total": self.tokens,
+                         "per_second": self.tokens / translating if translating else 0.0}
+
+        rep["lookup"] = {}
+        for jj in sorted(self.lookups):
+            c = self.lookups[jj]
+            rep["lookup"][str(jj)] = {"tries": c["tries"], "hits": c["hits"],
+                                      "hit_rate": c["hits"] / float(c["tries"]) if c["tries"] else 0.0}
+
+        if translator is not None:
+            counts = translator.lmcache.counts()
+            queries = counts["hits"] + counts["misses"]
+            rep["lm"] = {"queries": queries, "calls": counts["misses"],
+                         "queries_per_token": queries / float(self.tokens) if self.tokens else 0.0,
+                         "calls_per_token": counts["misses"] / float(self.tokens) if self.tokens else 0.0}
+
+        import lexicons
+        rss = lexicons.maxrss()
+        rep["peak_rss_mb"] = rss if rss == rss else None
+
+        if self.tracemalloc:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            rep["tracemalloc"] = {"current_mb": current / 1e6, "peak_mb": peak / 1e6, "top": [
+                {"where": str(stat.traceback), "mb": stat.size / 1e6, "count": stat.count}
+                for stat in tracemalloc.take_snapshot().statistics("lineno")[:TOPALLOCS]]}
+        return rep
+
+    def write(self, fname, translator=None):
+        """ Stop profiling and write the report to fname """
+        self.stop()
+        rep = self.report(translator)
+        with atomicwrite(fname) as out:
+            json.dump(rep, out, indent=2, sort_keys=True)
+        logger.info("Wrote profile to {0} ({1:.0f} tokens/s)".format(fname, rep["tokens"]["per_second"]))
+        return rep
@@ -1,26 +1,50 @@
-from apiclient.discovery import build
 import codecs
-import html.parser
-import shelve
+import html
 from collections import defaultdict
 import string
+import gtclient
+import transcache
 import utils
 
 # NICE TRY INTERNET
 API_KEY = utils.getapikey()
 
-def translatefile(fname, outfname, source, target, format="conll"):
+# limits on each request: characters (the API recommends under 5000) and sentences
+MAXCHARS = 5000
+MAXSENTS = 100
+WORKERS = 4
+
+def tokenize(outsent):
+    """ Unescape a translated sentence and split punctuation off its words. Returns a list of tokens. """
+    outsent = html.unescape(outsent)
+
+    tokens = []
+    for word in outsent.split():
+        while len(word) > 0 and word[0] in string.punctuation:
+            tokens.append(word[0])
+            word = word[1:]
+
+        if len(word) == 0:
+            continue
+
+        after = []
+        while len(word) > 0 and word[-1] in string.punctuation:
+            after.insert(0, word[-1])
+            word = word[:-1]
+
+        tokens.append(word)
+        tokens.extend(after)
+
+    return tokens
+
+def translatefile(fname, outfname, source, target, format="conll", endpoint=gtclient.ENDPOINT, workers=WORKERS,
+                  cachename=transcache.DEFAULTPATH):
     """
     Given a filename, an outfname, and a source and target languages, this will translate
     the first word of each tab-sep row in fname from source to target and write to outfname. Language codes are Google
     two letter codes (en, uz, tr, de, etc.)
     """
 
-    outlines = []
-    service = build('translate', 'v2',developerKey=API_KEY)
-
-    h = html.parser.HTMLParser()
-    
     if format == "conll":
         lines = utils.readconll(fname)
     elif format == "plaintext":
@@ -30,13 +54,13 @@ def translatefile(fname, outfname, source, target, format="conll"):
         exit()
 
 
-    memo = shelve.open("shelves/sents-" + source + "-" + target + ".shelf")
-        
+    cache = transcache.TranslationCache(cachename)
+
     sents = []
     sent = ""
 
     # gather all sentences
-    for line in lines:            
+    for line in lines:
         sline = line.split("\t")
         if len(sline) > 5:
             srcword = str(sline[5]).strip()
@@ -44,7 +68,7 @@ def translatefile(fname, outfname, source, target, format="conll"):
             #if srcword in ["'s","n't","'ve"]:
             #    sep = ""
             sent += sep + srcword
-            
+
         else:
             sent = sent.strip()
             sents.append(sent)
@@ -53,85 +77,60 @@ def translatefile(fname, outfname, source, target, format="conll"):
     if len(sent) > 0:
         sents.append(sent)
 
-            
-    chars = 0
-    trans = []
-    for sent in sents:
-        if sent not in memo:
-            trans.append(sent)
-            chars += len(sent)
-
+    # each distinct sentence that isn't already in the cache, in order of appearance.
+    memo = cache.get_many(source, target, "sentence", sents)
+    trans = list(dict.fromkeys(s for s in sents if s not in memo))
+    chars = sum(len(s) for s in trans)
 
     # calculate the cost and fail if user refuses
     utils.cost(chars)
-    
-    outsents = []
-    # gather a list of words to be translated.
-    for i in range(0, len(trans), 20):
-        isents = trans[i:i+50]
-        print("size of request:",len(isents))
-        try:
-            response = service.translations().list(source=source,target=target, q=isents).execute()
-            if len(response["translations"]) > 0:
-                translations = response["translations"]
-                for w,t in zip(isents,translations):
-                    tsent = t["translatedText"]
-                    memo[w] = tsent
-            else:
-                print("No translations...")
 
-        except Exception as e:
-            print("Whoops... exception")
-            print(e)
+    # sentence -> output tokens. Responses are tokenized here as they arrive,
+    # while the requests after them are still in flight.
+    tokenized = {}
+
+    client = gtclient.TranslateClient(API_KEY, endpoint, workers)
+    done = 0
+    sentchars = 0
+    failed = 0
+    for isents, translations in client.translateall(gtclient.chunkbychars(trans, MAXCHARS, MAXSENTS), source, target):
+        if translations is None:
+            failed += len(isents)
+            continue
+        cache.put_many(source, target, "sentence", zip(isents, translations))
+        for s, tsent in zip(isents, translations):
+            tokenized[s] = tokenize(tsent)
+        done += len(isents)
+        sentchars += sum(len(s) for s in isents)
+        utils.costprogress(done, len(trans), sentchars)
+
+    if failed > 0:
+        utils.logger.error("{0} sentences could not be translated, they are copied as is. Run again to retry them.".format(failed))
 
     outlines = []
 
     # these will be written to a file for fast_align to use.
     parlines = []
-    
-    for sent in sents:        
-        outsent = memo[sent]
-
-        # fix outsent?
-        # try some simple tokenization.
-        outsent = h.unescape(outsent)
-
-        tokens = []
-        for word in outsent.split():
-            while len(word) > 0 and word[0] in string.punctuation:
-                tokens.append(word[0])
-                word = word[1:]
-
-            if len(word) == 0:
-                continue
-
-            after = []
-            while len(word) > 0 and word[-1] in string.punctuation:
-                after.insert(0, word[-1])
-                word = word[:-1]
-
-            tokens.append(word)
-            tokens.extend(after)
-
-        outsent = " ".join(tokens)
-        
-        parlines.append(sent + " ||| " + outsent + "\n")
-        
-        #out.write(line);
-        ssent = outsent.split()
-        for w in ssent:
-            w = h.unescape(w)
 
+    for sent in sents:
+        if sent not in tokenized:
+            tokenized[sent] = tokenize(memo[sent]) if sent in memo else sent.split()
+        tokens = tokenized[sent]
+
+        parlines.append(sent + " ||| " + " ".join(tokens) + "\n")
+
+        for w in tokens:
+            w = html.unescape(w)
             if w.endswith("."):
                 outlines.append("O\t0\t0\tx\tx\t" + w[:-1] + "\tx\tx\t0\n")
                 outlines.append("O\t0\t0\tx\tx\t.\tx\tx\t0\n")
             else:
                 outlines.append("O\t0\t0\tx\tx\t" + w + "\tx\tx\t0\n")
-                   
+
         outlines.append("\n")
 
     with codecs.open("text.en-" + target, "w", "utf8") as out:
-        print("Writing to: text.en-" + target) 
+        print("Writing to: text.en-" + target)
         for line in parlines:
             out.write(line)
 
@@ -143,7 +142,7 @@ def translatefile(fname, outfname, source, target, format="conll"):
     else:
         print("Unknown format: " + format)
 
-    memo.close()
+    cache.close()
 
 if __name__ == "__main__":
     import argparse
@@ -154,8 +153,10 @@ if __name__ == "__main__":
     parser.add_argument("--source","-s", help="Source language code (2 letter)", default="en")
     parser.add_argument("--target","-t", help="Target language code (2 letter)", required=True)
     parser.add_argument("--format","-f", help="Format of input file", choices=["conll", "plaintext"], default="conll")
-    
+    parser.add_argument("--endpoint", help="Translate API endpoint (e.g. a local stub for testing)", default=gtclient.ENDPOINT)
+    parser.add_argument("--workers", "-w", help="Number of requests in flight", type=int, default=WORKERS)
+    parser.add_argument("--cache", help="Translation cache database", default=transcache.DEFAULTPATH)
+
     args = parser.parse_args()
-    
-    translatefile(args.input, args.output, args.source, args.target, args.format)
-    
+
+    translatefile(args.input, args.output, args.source, args.target, args.format, args.endpoint, args.workers, args.cache)
@@ -0,0 +1,299 @@
+#  -*- coding: utf-8 -*-
+""" A long-running translation server that keeps one warm Translator.
+
+Loading the lexicon and LM happens once at startup. Requests are POSTed to
+/translate (the body is a CoNLL or plaintext document, ?format= says which)
+over TCP or a Unix socket. They are put on a queue, and a single translating
+thread takes them off and translates them one after another, so concurrent
+requests share the Translator (and its LM cache) without locking. GET /stats
+returns latency, throughput and coverage counters as json.
+
+To run the server, and then translate a file with it:
+
+    $ python server.py -t tur --socket /tmp/translate.sock
+    $ python server.py client --socket /tmp/translate.sock -i eng.conll -o tur.conll
+"""
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import *
+
+# the translating thread takes off everything that arrives within BATCHWAIT seconds of
+# the first request, up to BATCHMAX requests, and then translates them in order
+BATCHWAIT = 0.005
+BATCHMAX = 64
+
+
+class Job:
+    """ One request waiting to be translated """
+
+    def __init__(self, lines, format):
+        self.lines = lines
+        self.format = format
+        self.arrived = time.time()
+        self.done = threading.Event()
+        self.finished = None
+        self.result = None
+        self.error = None
+
+
+class TranslationService:
+    """ Owns the Translator, the request queue and the counters """
+
+    def __init__(self, translator):
+        self.translator = translator
+        self.jobs = queue.Queue()
+
+        self.started = time.time()
+        # words and missing are the coverage counts. Only those are kept of each
+        # job's TranslationStats, so the counters stay the same size however long this runs.
+        self.counters = dict(requests=0, errors=0, batches=0, lines=0, busy=0.0,
+                             totallatency=0.0, maxlatency=0.0, words=0, missing=0)
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self.run, name="translator", daemon=True)
+        self.thread.start()
+
+    def submit(self, text, format):
+        """ Translate a document (blocking until it is done) and return the output text """
+        if format == "conll":
+            lines = text.splitlines(True)
+        elif format == "plaintext":
+            lines = []
+            for line in text.splitlines(True):
+                lines.extend(plaintexttolines(line))
+                lines.append("\n")
+        else:
+            raise ValueError("Format not known: " + format)
+
+        job = Job(lines, format)
+        self.jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def nextbatch(self):
+        batch = [self.jobs.get()]
+        deadline = time.time() + BATCHWAIT
+        while len(batch) < BATCHMAX:
+            try:
+                batch.append(self.jobs.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        import translate
+
+        # sqlite connections can only be used in the thread that made them, so the
+        # translation memory gets one of its own here.
+        self.translator.reopen()
+        while True:
+            batch = self.nextbatch()
+            start = time.time()
+            words, missing = 0, 0
+            for job in batch:
+                stats = translate.TranslationStats()
+                try:
+                    outlines = self.translator.translate_iter(job.lines, stats)
+                    if job.format == "conll":
+                        job.result = "".join(outlines)
+                    else:
+                        job.result = "".join(genplaintext(outlines))
+                    words += stats.total
+                    missing += stats.missing
+                except Exception as e:
+                    logger.exception("Failed to translate a request")
+                    job.error = e
+                job.finished = time.time()
+                job.done.set()
+
+            end = time.time()
+            with self.lock:
+                self.counters["batches"] += 1
+                self.counters["busy"] += end - start
+                self.counters["words"] += words
+                self.counters["missing"] += missing
+                for job in batch:
+                    latency = job.finished - job.arrived
+                    self.counters["requests"] += 1
+                    self.counters["errors"] += job.error is not None
+                    self.counters["lines"] += len(job.lines)
+                    self.counters["totallatency"] += latency
+                    self.counters["maxlatency"] = max(self.counters["maxlatency"], latency)
+
+    def report(self):
+        with self.lock:
+            c = dict(self.counters)
+        uptime = time.time() - self.started
+        c["uptime"] = uptime
+        c["queued"] = self.jobs.qsize()
+        c["meanlatency"] = c["totallatency"] / c["requests"] if c["requests"] else 0.0
+        c["linespersec"] = c["lines"] / c["busy"] if c["busy"] else 0.0
+        c["requestspersec"] = c["requests"] / uptime if uptime else 0.0
+        c["coverage"] = (c["words"] - c["missing"]) / float(c["words"]) if c["words"] else 0.0
+        c["lmcache"] = dict(self.translator.lmcache.counts())
+        return c
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def reply(self, code, body, ctype="text/plain; charset=utf-8"):
+        data = body.encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urllib.parse.urlparse(self.path).path == "/stats":
+            self.reply(200, json.dumps(self.server.service.report()), "application/json")
+        else:
+            self.reply(404, "not found\n")
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/translate":
+            self.reply(404, "not found\n")
+            return
+
+        format = urllib.parse.parse_qs(url.query).get("format", ["conll"])[0]
+        length = int(self.headers.get("Content-Length", 0))
+        text = self.rfile.read(length).decode("utf8")
+        try:
+            self.reply(200, self.server.service.submit(text, format))
+        except ValueError as e:
+            self.reply(400, str(e) + "\n")
+        except Exception as e:
+            self.reply(500, str(e) + "\n")
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = socketserver.UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects a (host, port) client address.
+        return request, ("local", 0)
+
+
+def serve(translator, host="localhost", port=8089, sockpath=None):
+    if sockpath:
+        if os.path.exists(sockpath):
+            os.remove(sockpath)
+        server = UnixHTTPServer(sockpath, Handler)
+        logger.info("Serving on " + sockpath)
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+        logger.info("Serving on http://{0}:{1}".format(host, port))
+
+    server.service = TranslationService(translator)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if sockpath and os.path.exists(sockpath):
+            os.remove(sockpath)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, sockpath, timeout=None):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.sockpath = sockpath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.sockpath)
+
+
+def request(method, path, body=None, url="http://localhost:8089", sockpath=None):
+    """ Send one request to a server, return the response body as text """
+    if sockpath:
+        conn = UnixHTTPConnection(sockpath)
+    else:
+        parsed = urllib.parse.urlparse(url)
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port)
+    try:
+        conn.request(method, path, body=body.encode("utf8") if body is not None else None)
+        resp = conn.getresponse()
+        text = resp.read().decode("utf8")
+        if resp.status != 200:
+            raise IOError("Server said {0}: {1}".format(resp.status, text.strip()))
+        return text
+    finally:
+        conn.close()
+
+
+def translatetext(text, format="conll", url="http://localhost:8089", sockpath=None):
+    """ Translate a document with a running server """
+    return request("POST", "/translate?format=" + format, text, url, sockpath)
+
+
+def translatefile(fname, outfname, format="conll", url="http://localhost:8089", sockpath=None):
+    """ Translate a file with a running server. A drop-in for running translate.py on it. """
+    with codecs.open(fname, "r", "utf-8") as f:
+        text = f.read()
+    out = translatetext(text, format, url, sockpath)
+    with codecs.open(outfname, "w", "utf-8") as f:
+        f.write(out)
+
+
+def getstats(url="http://localhost:8089", sockpath=None):
+    return json.loads(request("GET", "/stats", None, url, sockpath))
+
+
+if __name__ == "__main__":
+    import argparse
+    import lmcache
+    parser = argparse.ArgumentParser(description="Translation server (or, with 'client', a client for one)")
+
+    parser.add_argument("mode", nargs="?", choices=["serve", "client", "stats"], default="serve")
+    parser.add_argument("--host", help="Host to serve on", default="localhost")
+    parser.add_argument("--port", help="Port to serve on", type=int, default=8089)
+    parser.add_argument("--socket", help="Unix socket to serve on (instead of host/port)")
+
+    parser.add_argument("--method", help="Either google, or lexicon", choices=["lexicon", "google"], default="lexicon")
+    parser.add_argument("--source", "-s", help="Source language code (3 letter)", default="eng")
+    parser.add_argument("--target", "-t", help="Target language code (3 letter)")
+    parser.add_argument("--lexname", "-l", help="Name of special lexicon")
+    parser.add_argument("--lmcache", help="Number of LM scores to cache (0 to turn off)", type=int, default=lmcache.DEFAULTSIZE)
+    parser.add_argument("--beam", "-b", help="Beam width for sentence-level decoding (0 is greedy)", type=int, default=0)
+    parser.add_argument("--tm", help="Translation memory database to read and add to")
+    parser.add_argument("--topk", help="When pivoting the lexicon, keep this many targets per source", type=int)
+    parser.add_argument("--minprob", help="When pivoting the lexicon, drop targets scored below this", type=float, default=0.0)
+    parser.add_argument("--shared", help="Memory-map the phrase trie and LM, to share them between servers", action="store_true")
+
+    parser.add_argument("--input", "-i", help="(client) Input file name")
+    parser.add_argument("--output", "-o", help="(client) Output file")
+    parser.add_argument("--format", "-f", help="(client) Format of input file", choices=["conll", "plaintext"], default="conll")
+
+    args = parser.parse_args()
+    url = "http://{0}:{1}".format(args.host, args.port)
+
+    if args.mode == "client":
+        translatefile(args.input, args.output, args.format, url, args.socket)
+    elif args.mode == "stats":
+        print(json.dumps(getstats(url, args.socket), indent=2))
+    else:
+        if not args.target:
+            parser.error("--target is required to serve")
+        import translate
+        tt = translate.Translator(args.method, args.source, args.target, args.lexname, args.lmcache, args.beam, args.tm,
+                                  args.shared, args.topk, args.minprob)
+        serve(tt, args.host, args.port, args.socket)
@@ -9,22 +9,15 @@
 
 
 from sys import version_info
-if version_info >= (2, 6, 0):
+if version_info >= (2, 7, 0):
     def swig_import_helper():
-        from os.path import dirname
-        import imp
-        fp = None
+        import importlib
+        pkg = __name__.rpartition('.')[0]
+        mname = '.'.join((pkg, '_srilm')).lstrip('.')
         try:
-            fp, pathname, description = imp.find_module('_srilm', [dirname(__file__)])
+            return importlib.import_module(mname)
         except ImportError:
-            import _srilm
-            return _srilm
-        if fp is not None:
-            try:
-                _mod = imp.load_module('_srilm', fp, pathname, description)
-            finally:
-                fp.close()
-            return _mod
+            return importlib.import_module('_srilm')
     _srilm = swig_import_helper()
     del swig_import_helper
 else:
@@ -0,0 +1,87 @@
+#  -*- coding: utf-8 -*-
+""" Shared fixtures. The modules live at the top of the repository, so it goes on the path. """
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+class StubTranslate:
+    """ A local stand-in for the Translate v2 endpoint. It answers with the HTTP codes
+    in self.failures first (one per request), then translates each text t to "<target>:t".
+    Every request body is kept in self.requests. """
+
+    def __init__(self):
+        self.failures = []
+        self.requests = []
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf8"))
+                with stub.lock:
+                    stub.requests.append(body)
+                    code = stub.failures.pop(0) if len(stub.failures) > 0 else 200
+                if code != 200:
+                    self.send_error(code)
+                    return
+                translations = [{"translatedText": body["target"] + ":" + q} for q in body["q"]]
+                out = json.dumps({"data": {"translations": translations}}).encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.endpoint = "http://127.0.0.1:{0}/translate".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    def texts(self):
+        """ Every text sent, over all requests """
+        return [q for body in self.requests for q in body["q"]]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubTranslate()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def free(monkeypatch):
+    """ No cost check (it asks on stdin before a paid run) """
+    monkeypatch.setattr(utils, "cost", lambda chars: None)
+
+
+@pytest.fixture
+def conllfile(tmp_path):
+    """ Writes sentences (of space separated words) as tmp_path/in.conll, and returns its name """
+    def write(sentences):
+        fname = str(tmp_path / "in.conll")
+        with open(fname, "w", encoding="utf8") as out:
+            for sent in sentences:
+                for i, w in enumerate(sent.split()):
+                    out.write("O\t0\t{0}\tx\tx\t{1}\tx\tx\t0\n".format(i, w))
+                out.write("\n")
+        return fname
+    return write
@@ -0,0 +1,16 @@
+#  -*- coding: utf-8 -*-
+import googletrans
+
+
+def test_words_are_sent_once_then_cached(tmp_path, stub, free, conllfile):
+    fname = conllfile(["the dog saw the cat", "the cat saw the dog"])
+    cachename = str(tmp_path / "cache.db")
+
+    first = googletrans.getgooglemapping(fname, "en", "tr", stub.endpoint, 2, cachename)
+    assert first == {w: "tr:" + w for w in ["the", "dog", "saw", "cat"]}
+    assert sorted(stub.texts()) == ["cat", "dog", "saw", "the"]
+
+    stub.requests = []
+    second = googletrans.getgooglemapping(fname, "en", "tr", stub.endpoint, 2, cachename)
+    assert second == first
+    assert stub.requests == []
@@ -0,0 +1,53 @@
+#  -*- coding: utf-8 -*-
+import urllib.error
+
+import pytest
+
+import gtclient
+
+
+def client(stub, retries=5):
+    return gtclient.TranslateClient(None, stub.endpoint, workers=2, retries=retries, backoff=0.001, timeout=5)
+
+
+def test_retries_rate_limit_and_server_errors(stub):
+    stub.failures = [429, 503, 500]
+    assert client(stub).translatebatch(["a", "b"], "en", "tr") == ["tr:a", "tr:b"]
+    # three failures, then the one that worked
+    assert len(stub.requests) == 4
+    assert all(body["q"] == ["a", "b"] for body in stub.requests)
+
+
+def test_gives_up_after_retries(stub):
+    stub.failures = [503] * 10
+    with pytest.raises(urllib.error.HTTPError) as e:
+        client(stub, retries=2).translatebatch(["a"], "en", "tr")
+    assert e.value.code == 503
+    assert len(stub.requests) == 3
+
+
+def test_does_not_retry_client_errors(stub):
+    stub.failures = [400]
+    with pytest.raises(urllib.error.HTTPError):
+        client(stub).translatebatch(["a"], "en", "tr")
+    assert len(stub.requests) == 1
+
+
+def test_translateall_keeps_chunks_in_order(stub):
+    stub.failures = [429]
+    chunks = gtclient.chunkbycount(["w{0}".format(i) for i in range(10)], 3)
+    results = list(client(stub).translateall(chunks, "en", "de"))
+    assert [chunk for chunk, _ in results] == chunks
+    assert [translations for _, translations in results] == [["de:" + w for w in chunk] for chunk in chunks]
+    assert len(stub.requests) == len(chunks) + 1
+
+
+def test_translateall_reports_failed_chunks(stub):
+    stub.failures = [500] * 2
+    results = list(client(stub, retries=1).translateall([["a"]], "en", "tr"))
+    assert results == [(["a"], None)]
+
+
+def test_chunkbychars():
+    assert gtclient.chunkbychars(["aaa", "bb", "c", "dddddd"], 5, 10) == [["aaa", "bb"], ["c"], ["dddddd"]]
+    assert gtclient.chunkbychars(["a", "b", "c"], 100, 2) == [["a", "b"], ["c"]]
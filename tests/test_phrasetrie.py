@@ -0,0 +1,45 @@
+#  -*- coding: utf-8 -*-
+import lexcache
+import phrasetrie
+from phrasetrie import END, PhraseTrie, MappedTrie, isend
+
+KEYS = ["new", "new york", "new york city", "york", "los angeles", "the city"]
+
+
+def mapped(tmp_path, keys=KEYS):
+    fname, tname = str(tmp_path / "keys.trie"), str(tmp_path / "keys.tokens.lex")
+    phrasetrie.writetrie(keys, fname, tname)
+    return MappedTrie(fname, lexcache.CompiledLexicon(tname), set(keys))
+
+
+def ends(trie, tokens):
+    path = trie.path(tokens)
+    return [isend(path, n) for n in range(len(tokens) + 1)]
+
+
+def test_mapped_trie_walks_like_phrasetrie(tmp_path):
+    trie = mapped(tmp_path)
+    expected = PhraseTrie(KEYS)
+    for phrase in ["new york city hall", "new", "york city", "los", "los angeles", "the city", "city", "the new"]:
+        tokens = phrase.split(" ")
+        assert len(trie.path(tokens)) == len(expected.path(tokens))
+        assert ends(trie, tokens) == ends(expected, tokens)
+    assert trie.root.get("los").get("angeles") is not None
+    assert trie.root.get("angeles") is None
+    assert len(trie) == len(KEYS)
+
+
+def test_runtime_keys_end_on_mapped_prefixes(tmp_path):
+    trie = mapped(tmp_path)
+    # "los" and "the" are only prefixes in the mapped file
+    assert not isend(trie.path(["los"]), 1)
+    trie.add("los")
+    trie.add("the city hall")
+    trie.add("brand new")
+    assert isend(trie.path(["los"]), 1)
+    assert END in trie.root.get("los")
+    assert ends(trie, ["the", "city", "hall"]) == [False, False, True, True]
+    assert ends(trie, ["brand", "new"]) == [False, False, True]
+    assert "los" in trie and "brand new" in trie
+    # mapped keys are untouched
+    assert ends(trie, ["new", "york", "city"]) == [False, True, True, True]
@@ -0,0 +1,19 @@
+#  -*- coding: utf-8 -*-
+import senttrans
+
+
+def test_sentences_are_sent_once_then_cached(tmp_path, stub, free, conllfile, monkeypatch):
+    # translatefile writes its fast_align file to the working directory
+    monkeypatch.chdir(tmp_path)
+    fname = conllfile(["the dog barked", "a cat", "the dog barked"])
+    cachename = str(tmp_path / "cache.db")
+
+    senttrans.translatefile(fname, "out1.conll", "en", "tr", "conll", stub.endpoint, 2, cachename)
+    assert sorted(stub.texts()) == ["a cat", "the dog barked"]
+
+    stub.requests = []
+    senttrans.translatefile(fname, "out2.conll", "en", "tr", "conll", stub.endpoint, 2, cachename)
+    assert stub.requests == []
+    out = (tmp_path / "out2.conll").read_text(encoding="utf8")
+    assert (tmp_path / "out1.conll").read_text(encoding="utf8") == out
+    assert "tr:the" in out
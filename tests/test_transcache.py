@@ -0,0 +1,19 @@
+#  -*- coding: utf-8 -*-
+import transcache
+
+
+def test_cache_keeps_translations(tmp_path):
+    fname = str(tmp_path / "cache.db")
+    cache = transcache.TranslationCache(fname)
+    cache.put_many("en", "tr", "word", [("dog", "köpek"), ("cat", "kedi")])
+    # unflushed puts are seen
+    assert cache.get("en", "tr", "word", "dog") == "köpek"
+    cache.close()
+
+    cache = transcache.TranslationCache(fname)
+    assert cache.get_many("en", "tr", "word", ["dog", "cat", "cow", "dog"]) == {"dog": "köpek", "cat": "kedi"}
+    # the key includes the languages and the granularity
+    assert cache.get_many("en", "de", "word", ["dog"]) == {}
+    assert cache.get("en", "tr", "sentence", "dog") is None
+    cache.close()
+
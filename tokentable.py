@@ -0,0 +1,70 @@
+#  -*- coding: utf-8 -*-
+""" The tokens of a sentence, parsed once into columns.
+
+Each conll line is split once when it is read. The tag (column 0) and word
+(column 5) are kept in their own lists, and the columns around the word are
+kept joined, as they are only ever copied to the output. The lower cased
+words are kept too, as every lookup tries them. Translation works
+on token indexes into the table, and lines are only put back together by
+render, as they are written.
+"""
+
+
+class TokenTable:
+    """ Columns of the tokens of one sentence: tags, words (and lowers, the
+    words lower cased), and the text before (columns 1-4) and after (columns 6
+    on, with the newline) each word. """
+
+    __slots__ = ["tags", "words", "lowers", "pre", "post"]
+
+    def __init__(self):
+        self.tags = []
+        self.words = []
+        self.lowers = []
+        self.pre = []
+        self.post = []
+
+    def add(self, line):
+        """ Adds a conll line. Returns False (and adds nothing) if it has no word,
+        that is, if it is a sentence boundary. """
+        sline = line.split("\t")
+        if len(sline) <= 5:
+            return False
+        self.tags.append(sline[0])
+        self.words.append(sline[5])
+        self.lowers.append(sline[5].lower())
+        self.pre.append("\t".join(sline[1:5]))
+        self.post.append("\t" + "\t".join(sline[6:]) if len(sline) > 6 else "")
+        return True
+
+    @classmethod
+    def fromlines(cls, lines):
+        """ A table of the lines of one sentence """
+        table = cls()
+        for line in lines:
+            table.add(line)
+        return table
+
+    def __len__(self):
+        return len(self.words)
+
+    def line(self, i, tag, word):
+        """ The conll line of token i, with its tag and word replaced """
+        return tag + "\t" + self.pre[i] + "\t" + word + self.post[i]
+
+    def render(self, rows):
+        """ Turns (token index, tag, word) rows into conll lines """
+        return [self.line(i, tag, word) for i, tag, word in rows]
+
+
+def readsentences(lines):
+    """ Parses conll lines into a TokenTable per sentence. Yields (table, boundary)
+    pairs: boundary is False for the last sentence if no line with no word follows
+    it. A boundary with no sentence before it yields an empty table. """
+    table = TokenTable()
+    for line in lines:
+        if not table.add(line):
+            yield table, True
+            table = TokenTable()
+    if len(table) > 0:
+        yield table, False
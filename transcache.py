@@ -0,0 +1,97 @@
+#  -*- coding: utf-8 -*-
+""" A shared cache of translations bought from the Google API.
+
+Translations are kept in one SQLite table (see kvstore.py), keyed by
+(source, target, granularity, text), where granularity is "word" or
+"sentence". Lookups and inserts go in bulk, so concurrent jobs can share it.
+
+Older versions kept these in shelve files under shelves/. To move them over:
+
+    $ python transcache.py shelves/translatedict-en-tr.shelf shelves/sents-en-tr.shelf
+"""
+import os
+import re
+import shelve
+
+from kvstore import KVStore, BATCHSIZE
+from utils import logger
+
+DEFAULTPATH = "shelves/translations.db"
+
+
+class TranslationCache:
+
+    def __init__(self, fname=DEFAULTPATH):
+        self.fname = fname
+        self.store = KVStore(fname, "cache", ["source", "target", "granularity", "text"], "translation")
+
+    def get_many(self, source, target, granularity, texts):
+        """ Returns a dict of text -> translation for the texts that are in the cache """
+        return self.store.get_many((source, target, granularity), texts)
+
+    def get(self, source, target, granularity, text):
+        return self.store.get((source, target, granularity, text))
+
+    def put_many(self, source, target, granularity, pairs):
+        """ Add (text, translation) pairs. They are written when BATCHSIZE have built up, or on flush. """
+        self.store.put_many(((source, target, granularity, text), translation) for text, translation in pairs)
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+
+def shelfkind(fname):
+    """ (granularity, source, target) of a shelf written by an older googletrans or senttrans, from its name """
+    m = re.match(r"(translatedict|sents)-(\w+)-(\w+)\.shelf", os.path.basename(fname))
+    if m is None:
+        return None
+    granularity = "word" if m.group(1) == "translatedict" else "sentence"
+    return granularity, m.group(2), m.group(3)
+
+
+def migrateshelf(fname, cache):
+    """ Copy every entry of an old shelf into cache. Returns the number copied. """
+    # dbm may have added its own extension(s) to the name.
+    base = re.sub(r"\.(db|dat|dir|bak)$", "", fname)
+    kind = shelfkind(base)
+    if kind is None:
+        raise ValueError("Not a translatedict-* or sents-* shelf: " + fname)
+    granularity, source, target = kind
+
+    n = 0
+    with shelve.open(base, "r") as memo:
+        pairs = []
+        for text in memo:
+            pairs.append((text, memo[text]))
+            if len(pairs) >= BATCHSIZE:
+                cache.put_many(source, target, granularity, pairs)
+                n += len(pairs)
+                pairs = []
+        cache.put_many(source, target, granularity, pairs)
+        n += len(pairs)
+    cache.flush()
+
+    logger.info("Migrated {0} {1} translations {2}->{3} from {4}".format(n, granularity, source, target, base))
+    return n
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Copy old shelve caches into the translation cache")
+
+    parser.add_argument("shelves", nargs="+", help="Shelf files (shelves/translatedict-*.shelf, shelves/sents-*.shelf)")
+    parser.add_argument("--cache", help="Translation cache database", default=DEFAULTPATH)
+
+    args = parser.parse_args()
+
+    cache = TranslationCache(args.cache)
+    done = set()
+    for fname in args.shelves:
+        base = re.sub(r"\.(db|dat|dir|bak)$", "", fname)
+        if base not in done:
+            migrateshelf(fname, cache)
+            done.add(base)
+    cache.close()
@@ -1,19 +1,121 @@
 #  -*- coding: utf-8 -*-
 import codecs,os,re,random
 import html.parser
-from collections import defaultdict
-import string, math
-from srilm import *
+from collections import defaultdict, Counter
+import math
 from utils import *
+from phrasetrie import PhraseTrie, END, isend
+import lmcache
+import lexcache
+import morph
+import decoder
+import transmem
+from tokentable import readsentences
+
+
+# how often to log progress when the number of input lines isn't known
+PROGRESSLINES = 100000
+
+# roughly how many lines go to a worker at a time when translating in parallel
+CHUNKLINES = 5000
+
+
+def logprogress(lines):
+    """ Passes lines through, logging how far along we are """
+    numlines = len(lines) if hasattr(lines, "__len__") else None
+    progress = 0
+
+    for i, line in enumerate(lines):
+        if numlines:
+            currprog = i / float(numlines)
+            if currprog > progress+0.1:
+                logger.info(currprog)
+                progress = currprog
+        elif i > 0 and i % PROGRESSLINES == 0:
+            logger.info("{0} lines".format(i))
+        yield line
+
+
+class TranslationStats:
+    """ Coverage counts for a translation run """
+
+    def __init__(self):
+        self.total = 0
+        self.missing = 0
+        self.missedwords = defaultdict(int)
+        self.lmcache = Counter()
+        self.tm = Counter()
+
+    def merge(self, other):
+        """ Add the counts of other into this """
+        self.total += other.total
+        self.missing += other.missing
+        for w, s in other.missedwords.items():
+            self.missedwords[w] += s
+        self.lmcache.update(other.lmcache)
+        self.tm.update(other.tm)
+
+    def todict(self):
+        """ The counts, but not the missed words, as a json-able dict (see fromdict) """
+        return {"total": self.total, "missing": self.missing,
+                "lmcache": dict(self.lmcache), "tm": dict(self.tm)}
+
+    @classmethod
+    def fromdict(cls, d, missedwords=()):
+        """ The stats of the counts d (from todict) and the dict of missedwords """
+        stats = cls()
+        stats.total = d["total"]
+        stats.missing = d["missing"]
+        stats.missedwords.update(missedwords)
+        stats.lmcache.update(d["lmcache"])
+        stats.tm.update(d["tm"])
+        return stats
+
+    def report(self):
+        if self.total == 0:
+            logger.info("nothing was translated")
+            return
+
+        coverage = (self.total - self.missing) / float(self.total)    
+        logger.info("translated {0} of the corpus".format(coverage))
+
+        if len(self.missedwords) > 0:
+            logger.debug("Most popular missed words:")
+            for w,s in sorted(self.missedwords.items(), key=lambda p: p[1], reverse=True)[:10]:
+                logger.debug("{0} : {1}".format(w, s))
+
+        lmcache.report(self.lmcache)
+
+        lookups = self.tm["hits"] + self.tm["misses"]
+        if lookups > 0:
+            logger.info("Translation memory: {0} hits, {1} misses ({2:.1%} hit rate)".format(
+                self.tm["hits"], self.tm["misses"], self.tm["hits"] / float(lookups)))
 
 
 class Translator:
 
-    def __init__(self, method, source, target, lexname=None):
+    def __init__(self, method, source, target, lexname=None, lmcachesize=lmcache.DEFAULTSIZE, beam=0,
+                 tmpath=None, shared=False, topk=None, minprob=0.0):
         """ Method can be google or lexicon, source/target are
         3 letter names, lexname is the name of a specific lexicon
-        (needs to be gzipped masterlex format) """
-
+        (needs to be gzipped masterlex format), lmcachesize is the number
+        of LM scores to cache (0 for none). With beam > 0, sentences are
+        decoded with a beam of that width (see decoder.py) instead of greedily.
+        tmpath is a translation memory database (see transmem.py) to use.
+        With shared, the phrase trie and the LM are memory-mapped from files next
+        to the compiled lexicon, so that processes on one host share a single copy
+        (a mapped trie is slower to walk than the in-memory one). topk and minprob prune a mapping pivoted through english
+        (see lexicons.pivot). """
+
+        # enough to build an identical Translator in a worker process.
+        self.spec = dict(method=method, source=source, target=target, lexname=lexname,
+                         lmcachesize=lmcachesize, beam=beam, tmpath=tmpath, shared=shared,
+                         topk=topk, minprob=minprob)
+
+        # longest phrase to look up
+        self.window = 4
+        self.beam = beam
+        self.shared = shared
         
         self.method = method
         self.source = source
@@ -21,8 +123,17 @@ class Translator:
         self.lm = None
 
         self.lexname = lexname
+        self.topk = topk
+        self.minprob = minprob
         self.load_dictionary()
         self.load_lm()
+        self.lmcache = lmcache.LMCache(self.lmprob, lmcachesize)
+
+        # per-run substitution table for words that aren't in the lexicon as they
+        # are (see prepass): lower cased phrase -> the lexicon key its nearest
+        # vector neighbour maps to (or None). Morphological expansions are
+        # memoized by self.morph.
+        self.vecsubs = {}
 
         # Change this here if you want to...
         self.usevecs = False
@@ -37,56 +148,131 @@ class Translator:
         else:
             logger.info("Not using taglists!")        
 
-            
-    def load_dictionary(self):
-        import lexicons
-        
-        if self.lexname:
-            logger.info("Opening special lexicon: " + self.lexname)
+        self.tm = None
+        if tmpath:
+            self.tm = transmem.TranslationMemory(tmpath, self.fingerprint())
 
-            dct = defaultdict(lambda: defaultdict(float))
-            e2f,f2e,pairs = lexicons.readlexicon(self.lexname)
 
-            # normalize the dictionary with scores.
-            for k in list(e2f.keys()):
+    def reopen(self):
+        """ Opens a new connection to the translation memory, for use in another
+        thread or a forked process (a database connection can't be shared). """
+        if self.tm is not None:
+            self.tm = transmem.TranslationMemory(self.tm.fname, self.tm.fingerprint)
 
-                scores = [(w, pairs[(k,w)]) for w in e2f[k]]
+    def fingerprint(self):
+        """ Identifies everything (other than the input) that the output depends on """
+        import lexicons
 
-                t1 = float(sum([p[1] for p in scores]))
-                t1 = max(0.1, t1)
-                nscores = sorted([(p[0], p[1] / t1) for p in scores], key=lambda p: p[1])
+        parts = [self.method, self.source, self.target, self.window, self.beam,
+                 self.usevecs, self.usetaglists, self.topk, self.minprob]
+        if self.lmprob is not None:
+            parts.append(self.lmprob.__module__)
 
-                for p in nscores:
-                    dct[k][p[0]] += p[1]
+        for fname in lexicons.lexiconsources(self.source, self.target, self.lexname) + [LMPATH]:
+            if os.path.exists(fname):
+                st = os.stat(fname)
+                parts.append([os.path.abspath(fname), st.st_mtime, st.st_size])
+        return transmem.fingerprint(parts)
 
-            self.dct = dct
+    def load_dictionary(self):
+        import lexicons
+        
+        if self.lexname:
+            logger.info("Opening special lexicon: " + self.lexname)
+            self.dct = self.load_compiled()
             
         elif self.method == "google":
             #import googletrans
             #self.dct = googletrans.getgooglemapping(fname, self.source, self.target)
             logger.error("Doesn't work right now...")
         elif self.method == "lexicon":
-            self.dct,_ = lexicons.getlexiconmapping(self.source, self.target)
+            self.dct = self.load_compiled()
 
         else:
             logger.error("Mapping needs to be lexicon or google, is:", self.method)
             self.dct = None
 
-    def load_lm(self):
-        # read the LM
-        self.lm = initLM(3)
+        # the longest-match lookup in translate walks this instead of probing self.dct.
+        # Shared, it is compiled next to the lexicon and mapped rather than rebuilt.
+        if self.dct is None:
+            return
+        if self.shared and isinstance(self.dct, lexcache.CompiledLexicon):
+            self.trie = lexicons.loadmappedtrie(self.source, self.target, self.lexname, self.dct, self.topk,
+                                                self.minprob)
+            logger.info("Mapped phrase trie over {0} keys".format(len(self.trie)))
+        else:
+            self.trie = PhraseTrie(self.dct)
+            logger.info("Built phrase trie over {0} keys".format(len(self.trie)))
+        self.morph = morph.expander(self.source, self.trie.tokens)
+
+    def load_compiled(self):
+        """ Load the compiled (memory-mapped) lexicon, compiling it if it is stale.
+        If it can't be written, fall back to building the mapping in memory, in the
+        same compact layout. """
+        import lexicons
 
-        if os.path.exists(LMPATH):
-            logger.info("Reading " + LMPATH)
-            readLM(self.lm, LMPATH)
-            logger.info("done reading.")
+        try:
+            return lexicons.loadcompiled(self.source, self.target, self.lexname, self.topk, self.minprob)
+        except (IOError, OSError) as e:
+            logger.warning("Cannot use compiled lexicon ({0}), building in memory.".format(e))
+
+        if self.lexname:
+            dct = lexicons.getlexnamemapping(self.lexname)
         else:
+            dct, _ = lexicons.getlexiconmapping(self.source, self.target, self.topk, self.minprob)
+        return lexcache.CompactLexicon.frommapping(dct)
+
+    def load_lm(self):
+        """ Read the LM with SRILM, or with the built in ARPA reader
+        (arpalm) if the _srilm extension isn't available. """
+        self.lm = None
+        self.lmprob = None
+
+        if not os.path.exists(LMPATH):
             logger.info("No LM today")
+            return
+
+        if self.shared:
+            try:
+                import arpalm
+                self.lm = arpalm.loadshared(LMPATH, COMPILEDPATH + os.path.basename(LMPATH) + ".lm", 3)
+                self.lmprob = arpalm.getNgramProb
+                return
+            except (ImportError, IOError, OSError, ValueError) as e:
+                logger.warning("Cannot share the LM ({0}), reading a private copy.".format(e))
+
+        try:
+            import srilm as lmlib
+        except ImportError:
+            logger.info("No _srilm extension, using the ARPA reader.")
+            import arpalm as lmlib
+
+        self.lm = lmlib.initLM(3)
+        logger.info("Reading " + LMPATH)
+        lmlib.readLM(self.lm, LMPATH)
+        logger.info("done reading.")
+        self.lmprob = lmlib.getNgramProb
 
     def load_vecs(self):
-        from gensim.models.word2vec import Word2Vec
-        VECPATH=""
-        self.vecs = Word2Vec.load_word2vec_format(VECPATH, binary=True)
+        """ Load the vector index over the lexicon keys, building it from VECPATH
+        (which needs gensim) if it is missing or stale. """
+        import lexicons
+        import vecindex
+
+        prefix = lexicons.vecindexname(self.source, self.target, self.lexname, self.topk, self.minprob)
+        sources = [VECPATH, lexicons.compiledname(self.source, self.target, self.lexname, self.topk, self.minprob)]
+        if newerthan(vecindex.filenames(prefix), sources):
+            logger.info("Using vector index " + prefix)
+            self.vecindex = vecindex.VectorIndex.load(prefix)
+        else:
+            from gensim.models import KeyedVectors
+            logger.info("Building vector index from " + VECPATH)
+            vecs = KeyedVectors.load_word2vec_format(VECPATH, binary=True)
+            self.vecindex = vecindex.VectorIndex.build(vecs, list(self.dct))
+            try:
+                self.vecindex.save(prefix)
+            except (IOError, OSError) as e:
+                logger.warning("Cannot save vector index ({0}), using it from memory.".format(e))
         logger.info("Done loading...")
         self.sims = {}
 
@@ -110,123 +296,204 @@ class Translator:
             logger.info("Loaded " + tgname)
         
     def get_similar(self, word):
-        """ Use word vectors for word expansion """
+        """ Use word vectors for word expansion. Returns [] for a word with no vector. """
         if word in self.sims:
             return self.sims[word]
         else:
             word = word.lower()
-            cands= self.vecs.most_similar(word, topn=10)
+            try:
+                cands = self.vecindex.similar(word, 10)
+            except KeyError:
+                cands = []
             self.sims[word] = cands
             return cands
-        
+
+    def expand(self, word):
+        """ The morphological expansions of word in the source language, memoized """
+        return self.morph.expand(word)
+
+    def vecsub(self, phrase):
+        """ The lexicon key that the lower cased phrase is replaced with by
+        vector expansion, or None. Memoized. """
+        if phrase not in self.vecsubs:
+            self.vecsubs[phrase] = None
+            for w, _ in self.get_similar(phrase):
+                if w in self.dct:
+                    self.vecsubs[phrase] = w
+                    break
+        return self.vecsubs[phrase]
+
+    def prepass(self, sentences):
+        """ Resolve the unknown words and phrases of sentences (from readsentences) in
+        bulk, so that translating them afterwards costs a table lookup each. These are
+        the windows that lookup can't find as they are or lower cased: the vector
+        substitutes of all of them are found with one matrix product per block, or
+        else the expansions of their last word are. """
+        words = set()
+        phrases = set()
+        for sent, _ in sentences:
+            for i in range(len(sent)):
+                window = sent.words[i:i+self.window]
+                lowers = sent.lowers[i:i+self.window]
+                path = self.trie.path(window)
+                lowpath = self.trie.path(lowers)
+                for jj in range(1, len(window) + 1):
+                    if isend(path, jj) or isend(lowpath, jj):
+                        continue
+                    if self.usevecs:
+                        phrases.add(" ".join(lowers[:jj]))
+                    elif len(path) >= jj and window[jj-1] != "":
+                        words.add(window[jj-1])
+
+        if self.usevecs:
+            phrases = [p for p in phrases if p not in self.vecsubs]
+            for p, cands in self.vecindex.similarmany(phrases, 10).items():
+                self.sims[p] = cands
+            for p in phrases:
+                self.vecsub(p)
+            logger.info("Prepass: {0} unresolved phrases".format(len(phrases)))
+        else:
+            for w in words:
+                self.expand(w)
+            logger.info("Prepass: {0} unresolved words".format(len(words)))
+
+    def lookup(self, words, lowers, path, lowpath, jj):
+        """ Returns the key in self.dct for the first jj window words, trying them as
+        they are, lower cased, and expanded, in that order. Returns None if none
+        is in the lexicon. path and lowpath are the trie walks of words and lowers. """
+        if isend(path, jj):
+            return " ".join(words[:jj])
+
+        # try lower case
+        if isend(lowpath, jj):
+            return " ".join(lowers[:jj])
+
+        if self.usevecs:
+            # This activates the vector expansion.
+            return self.vecsub(" ".join(lowers[:jj]))
+
+        # expansions only change the last word, so this needs the rest to be a prefix.
+        elif len(path) >= jj and words[jj-1] != "":
+            node = path[jj-1]
+            for w in self.expand(words[jj-1]):
+                child = node.get(w)
+                if child is not None and END in child:
+                    return " ".join(words[:jj-1] + [w])
+
+        return None
+
     def translate(self, lines):
         """ The main function """
-        outlines = []
-        missing = 0
-        total = 0
-        missedwords = defaultdict(int)
-        h = html.parser.HTMLParser()
-
-        # this is a set of words to be ignored when counting translation failures
-        ignores = list(string.punctuation)
-        ignores.extend(list(map(str, list(range(2050)))))
-        ignores.append("-DOCSTART-")
-        ignores.append("--")
+        stats = TranslationStats()
+        sentences = list(readsentences(logprogress(lines)))
+        self.prepass(sentences)
+        outlines = list(self.translate_sentences(sentences, stats))
+        stats.report()
+        return outlines
+
+    def translate_iter(self, lines, stats=None, first=True):
+        """ Translate an iterable of conll lines, one sentence at a time. Output lines
+        are yielded as soon as their sentence is done, so only the current sentence
+        is ever held in memory. first says whether these lines start the output (the
+        first word of every later sentence is capitalized). """
+        # each line is parsed once, into the token table of its sentence. A line with
+        # no word ends the sentence (and breaks the LM context).
+        return self.translate_sentences(readsentences(lines), stats, first)
+
+    def translate_sentences(self, sentences, stats=None, first=True):
+        """ Like translate_iter, but for sentences already parsed by readsentences """
+        if stats is None:
+            stats = TranslationStats()
+        lmbefore = self.lmcache.counts()
+        translate = self.translate_sentence if self.tm is None else self.translate_remembered
+
+        for sent, boundary in sentences:
+            if len(sent) > 0:
+                for outline in sent.render(translate(sent, first, stats)):
+                    yield outline
+            if boundary:
+                yield "\n"
+                first = False
+
+        stats.lmcache.update(self.lmcache.counts() - lmbefore)
+        if self.tm is not None:
+            self.tm.flush()
+
+    def translate_remembered(self, sent, first, stats):
+        """ Like translate_sentence, but looks the sentence up in the translation
+        memory first, and stores it there if it isn't found. """
+        key = self.tm.key(sent, first)
+        hit = self.tm.get(key)
+        if hit is not None:
+            rows, total, missing, missedwords = hit
+            stats.tm["hits"] += 1
+            stats.total += total
+            stats.missing += missing
+            for w, c in missedwords.items():
+                stats.missedwords[w] += c
+            return rows
+
+        stats.tm["misses"] += 1
+        sentstats = TranslationStats()
+        rows = self.translate_sentence(sent, first, sentstats)
+        self.tm.put(key, rows, sentstats.total, sentstats.missing, sentstats.missedwords)
+        stats.merge(sentstats)
+        return rows
+
+    def translate_sentence(self, sent, first, stats):
+        """ Translate a single sentence, given as a TokenTable. Returns the output
+        as (token index, tag, word) rows, see TokenTable.render. first is True if
+        nothing comes before this sentence in the output. """
+        if self.beam > 0:
+            return decoder.decode(self, sent, first, stats)
+
+        outrows = []
 
         # with word translations in hand, run over file again and translate each word
         # if Google translation is not available for a word, it returns that word.
         # confusing b/c it is possible that the translation is the exact word.    
         i = 0
-        progress = 0
-        window = 4
-        while True:
-            currprog = i / float(len(lines))
-            if currprog > progress+0.1:
-                logger.info(currprog)
-                progress = currprog
+        window = self.window
+        while i < len(sent):
 
-            # Stopping condition!
-            if i >= len(lines):
-                break
-
-            # open a window after position i, but stop if encounter a break.
-            words = []
-            tags = []
-            for line in lines[i:i+window]:
-                wd = getword(line)
-                tag = gettag(line)
-                if wd is None:
-                    break
-
-                words.append(wd)
-                tags.append(tag)
-
-            # allow that no words will be found (empty line)
-            if len(words) == 0:
-                outlines.append("\n")
-                i += 1
-                continue
-
-            # the current line.
-            sline = lines[i].split("\t")
+            # open a window after position i.
+            words = sent.words[i:i+window]
+            tags = sent.tags[i:i+window]
 
-            # if the line has an empty word, fill it with something.
-            if len(sline) > 5 and sline[5] == "":
-                sline[5] = "x"
+            addrows = []
 
-            addlines = []
+            # walk the trie once for the original and lower cased words. The walks
+            # stop as soon as no key continues, which bounds the phrase length.
+            lowers = sent.lowers[i:i+window]
+            path = self.trie.path(words)
+            lowpath = self.trie.path(lowers)
 
             # start with the full number of words, and remove words as necessary
             found = False
             for jj in range(len(words), 0, -1):
                 srcwords = words[:jj]
                 srctags = tags[:jj]
-                srcphrase = " ".join(srcwords)
-                
-                hit = srcphrase in self.dct
 
-                # try lower case
-                if not hit:
-                    hit = srcphrase.lower() in self.dct
-                    if hit:
-                        srcphrase = srcphrase.lower()                
-                
-                if not hit:
-                    srcexpand = englishexpand(srcphrase)
-                    try:
-                        # This activates the vector expansion.
-                        if self.usevecs:
-                            wordscores = self.get_similar(srcphrase.lower())
-                            srcexpand = map(lambda p: p[0], wordscores)
-                        for w in srcexpand:
-                            if w in self.dct:                                
-                                srcphrase = w
-                                hit = srcphrase in self.dct
-                                break
-                    except KeyError:
-                        pass
+                srcphrase = self.lookup(words, lowers, path, lowpath, jj)
+                hit = srcphrase is not None
 
                 # If srcphrase is a name, we want to translate it into the text.
                 # if first tag is B-TAG, and first matches tag of last, then 
                 if self.usetaglists and not hit and srctags[0][0] == "B" and srctags[0][2:] == srctags[-1][2:]:
                     # get a random name from the gazetteers, put it in the dictionary.
                     taglist = self.taglists[srctags[0][2:]]
+                    srcphrase = " ".join(srcwords)
                     self.dct[srcphrase] = [(random.choice(taglist), 1.)]
+                    self.trie.add(srcphrase)
                     hit = True
                                         
                 if hit:
                     # these are now also associated with a score.
                     opts = self.dct[srcphrase]
 
-                    # ngram decides how far back we will go
-                    ngram = min(3, len(outlines))
-                    context = []
-                    for rev in range(-ngram, 0, 1):
-                        c = getword(outlines[rev])
-                        if c is None:
-                            context = []
-                        else:
-                            context.append(c)
+                    # ngram decides how far back we will go (the context never
+                    # crosses a sentence boundary)
+                    context = [r[2] for r in outrows[-3:]]
 
                     newopts = dict(opts)
                     # select the best option using LM
@@ -235,8 +502,7 @@ class Translator:
                             score = newopts[opt] + 0.0000001
                             if len(opt.split()) == 0:
                                 continue
-                            text = " ".join(context + [opt.split()[0]])
-                            lmscore = getNgramProb(self.lm, text, len(context)+1)
+                            lmscore = self.lmcache.score(self.lm, context, opt.split()[0])
                             newopts[opt] = lmscore + math.log(score)
 
                     best = max(list(newopts.items()), key=lambda p: p[1])
@@ -247,29 +513,9 @@ class Translator:
                         logger.debug("{0} : {1} ({2})".format(srcphrase, sb[0], sb[1]))
                     logger.debug("")
 
-                    w = html.unescape(w)
-
-                    # if last word is an empty line capitalize this word.
-                    if len(outlines) > 0  and getword(outlines[-1]) == None:
-                        w = w.capitalize()
-                    
-                    transwords = w.split()
-
-                    # this allows us to transfer exact lines from source
-                    kk = 0
-                    for wind,word in enumerate(transwords):
-                        line = lines[i + kk]
-                        newsline = line.split("\t")
-                        newsline[5] = word
-
-                        if wind > 0 and len(srcwords) == 1 and lines[i][0] == "B":
-                            _,tag = newsline[0].split("-")
-                            newsline[0] = "I-" + tag
-
-                        addlines.append("\t".join(newsline))
-
-                        if kk < len(srcwords) - 1:
-                            kk+=1 
+                    # if this word starts a sentence (other than the first) capitalize it.
+                    capitalize = len(outrows) == 0 and not first
+                    addrows.extend(self.outputrows(sent, i, jj, w, capitalize))
 
                     i += jj                
 
@@ -278,6 +524,8 @@ class Translator:
 
             # word not in dict. srcphrase has just 1 token
             if not found:
+                srcphrase = words[0]
+
                 # check if lexicon doesn't contain element
                 #removes = ["the", "said", "was", "has", "been", "were", "'s", "are"]
                 removes = []
@@ -294,65 +542,156 @@ class Translator:
                 if len(groups) > 0 and False:
 
                     # if there is a tag.
-                    tag = sline[0]
+                    tag = tags[0]
 
                     g = groups[0]
                     ssp = srcphrase.split(g)
 
                     for chunk in ssp:
-                        sline[0] = tag
-                        sline[5] = chunk
                         if len(chunk) > 0:
-                            addlines.append("\t".join(sline))
+                            addrows.append((i, tag, chunk))
 
                         if tag[0] == "B":
                             tag = "I" + tag[1:]
                         
-                        sline[0] = tag
-                        sline[5] = g
-                        addlines.append("\t".join(sline))
+                        addrows.append((i, tag, g))
                         
                     # because we added too many...
-                    addlines.pop()
+                    addrows.pop()
 
-                    missing += 1
+                    stats.missing += 1
                     
                 else:
                     #logger.debug("skip: {0}".format(srcphrase))
-                    addlines.append("\t".join(sline))
-                    if srcphrase not in ignores:
-                        missing += 1
-                        missedwords[srcphrase] += 1
+                    # if the line has an empty word, fill it with something.
+                    addrows.append((i, tags[0], words[0] if words[0] != "" else "x"))
+                    if srcphrase not in IGNORES:
+                        stats.missing += 1
+                        stats.missedwords[srcphrase] += 1
                 i += 1
 
-            total += 1
-
-            for line in addlines:
-                outlines.append(line) 
-
-        coverage = (total - missing) / float(total)    
-        logger.info("translated {0} of the corpus".format(coverage))
-
-        if len(missedwords) > 0:
-            logger.debug("Most popular missed words:")
-            for w,s in sorted(missedwords.items(), key=lambda p: p[1], reverse=True)[:10]:
-                logger.debug("{0} : {1}".format(w, s))
-            
-        return outlines
-
-    def translate_file(self, fname, outfname, format="conll"):
-        """ This actually does the translation, given a word mapping."""
+            stats.total += 1
+
+            for row in addrows:
+                outrows.append(row) 
+
+        return outrows
+
+    def outputrows(self, sent, i, jj, w, capitalize):
+        """ The output rows for translating the jj tokens of sent starting at i as w """
+        w = html.unescape(w)
+        if capitalize:
+            w = w.capitalize()
+
+        transwords = w.split()
+
+        # this allows us to transfer exact lines from source
+        rows = []
+        kk = 0
+        for wind,word in enumerate(transwords):
+            tag = sent.tags[i + kk]
+
+            if wind > 0 and jj == 1 and sent.tags[i][:1] == "B":
+                _,tag = tag.split("-")
+                tag = "I-" + tag
+
+            rows.append((i + kk, tag, word))
+
+            if kk < jj - 1:
+                kk+=1 
+
+        return rows
+
+    def translate_parallel(self, lines, workers, stats, first=True):
+        """ Like translate_iter, but chunks of sentences are translated in a pool of
+        worker processes, each with its own Translator built from self.spec. Output
+        comes back in order and is identical to the serial output; the coverage
+        counts of all the workers are merged into stats. """
+        for outlines, chunkstats in self.translate_chunks(lines, workers, first):
+            stats.merge(chunkstats)
+            for outline in outlines:
+                yield outline
+
+    def translate_chunk(self, lines, first):
+        """ Translate a list of lines that ends at a sentence boundary. Returns the
+        output lines and their TranslationStats. """
+        stats = TranslationStats()
+        sentences = list(readsentences(lines))
+        self.prepass(sentences)
+        outlines = list(self.translate_sentences(sentences, stats, first))
+        return outlines, stats
+
+    def translate_chunks(self, lines, workers=1, first=True):
+        """ Yields (output lines, stats) for each chunk of about CHUNKLINES lines, in
+        order. With workers > 1 the chunks are translated in a pool of processes. """
+        if workers <= 1:
+            for chunk in chunksentences(lines, CHUNKLINES):
+                yield self.translate_chunk(chunk, first)
+                first = False
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+        from collections import deque
+        import forkpool
+
+        if self.shared and forkpool.canfork():
+            # forked workers use this Translator as it is (its big tables are mapped files).
+            global _worker
+            _worker = self
+            pool = forkpool.ForkPool(workers, _initforked)
+        else:
+            pool = ProcessPoolExecutor(workers, initializer=_initworker, initargs=(self.spec,))
+
+        with pool:
+            # keep a bounded number of chunks in flight so memory stays flat.
+            pending = deque()
+            for chunk in chunksentences(lines, CHUNKLINES):
+                pending.append(pool.submit(_translatechunk, chunk, first))
+                first = False
+
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+
+            while len(pending) > 0:
+                yield pending.popleft().result()
+
+    def translate_file(self, fname, outfname, format="conll", workers=1, checkpoint=0, resume=False,
+                       prepass=False):
+        """ This actually does the translation, given a word mapping. The input
+        is streamed: each sentence is read, translated and written before the next.
+        With workers > 1, sentences are translated in that many processes. With
+        checkpoint > 0, a checkpoint is taken about every that many sentences, and
+        with resume, the run carries on from the last one (see checkpoint.py).
+        Either way the input goes in chunks, each with its own prepass. Otherwise,
+        with prepass, the whole input is read once more first for the prepass, and
+        the table of its unknown words and phrases is held for the run. """
+
+        if checkpoint > 0 or resume:
+            import checkpoint as ckpt
+            if ckpt.seekable(outfname):
+                return self.translate_checkpointed(fname, outfname, format, workers, checkpoint, resume)
+            if resume:
+                logger.error("Can't resume writing to {0}, it isn't a regular file".format(outfname))
+                exit()
+            logger.warning("{0} isn't a regular file, not taking checkpoints".format(outfname))
 
         if format == "conll":
-            lines = readconll(fname)
+            readlines = iterconll
         elif format == "plaintext":
-            lines = readplaintext(fname)
+            readlines = iterplaintext
         else:
             print("Format not known: " + format)
             exit()
 
         # everything is done in conll format. That is... one word per line. 
-        outlines = self.translate(lines)
+        stats = TranslationStats()
+        lines = logprogress(readlines(fname))
+        if workers > 1:
+            outlines = self.translate_parallel(lines, workers, stats)
+        else:
+            if prepass:
+                self.prepass(readsentences(readlines(fname)))
+            outlines = self.translate_iter(lines, stats)
 
         print("Writing to:", outfname)
         if format == "conll":
@@ -361,10 +700,177 @@ class Translator:
             writeplaintext(outfname, outlines)
         else:
             print("Unknown format: " + format)
-    
+
+        stats.report()
+
+    def translate_checkpointed(self, fname, outfname, format, workers, every, resume):
+        """ translate_file, with checkpoints every that many sentences (checkpoint.EVERY
+        if every is 0, when resuming) """
+        import checkpoint
+        from collections import deque
+
+        every = every or checkpoint.EVERY
+
+        if format not in ["conll", "plaintext"]:
+            print("Format not known: " + format)
+            exit()
+
+        ckpt = checkpoint.Checkpoint(checkpoint.checkpointname(outfname), fname, outfname, format, self.spec)
+        state = None
+        if resume:
+            try:
+                state = ckpt.load()
+            except ValueError as e:
+                logger.error(str(e))
+                exit()
+            if state is None:
+                logger.info("No checkpoint to resume from, starting from the beginning")
+
+        stats = TranslationStats()
+        inoffset, outoffset, sentences = 0, 0, 0
+        if state is not None:
+            inoffset, outoffset, sentences = state["inoffset"], state["outoffset"], state["sentences"]
+            stats = TranslationStats.fromdict(state["stats"], state["missedwords"])
+
+        # the input offset after each sentence boundary read, to be taken off as the
+        # sentence is written.
+        boundaries = deque()
+        lines = logprogress(checkpoint.readfrom(fname, format, inoffset, boundaries))
+        # the first word of the output is only capitalized at the very start.
+        chunks = self.translate_chunks(lines, workers, inoffset == 0)
+
+        print("Writing to:", outfname)
+        with open(outfname, "r+b" if state is not None else "wb") as out:
+            # anything written after the checkpoint is written again.
+            out.truncate(outoffset)
+            out.seek(outoffset)
+            saved = sentences
+            # the words missed since the last checkpoint
+            missed = Counter()
+            for outlines, chunkstats in chunks:
+                stats.merge(chunkstats)
+                missed.update(chunkstats.missedwords)
+                writechunk(out, outlines, format)
+
+                # a chunk ends at a boundary, so its sentences are all written.
+                for outline in outlines:
+                    if getword(outline) is None:
+                        inoffset = boundaries.popleft()
+                        sentences += 1
+
+                if sentences - saved >= every > 0:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    ckpt.save(inoffset, out.tell(), sentences, stats.todict(), missed)
+                    saved = sentences
+                    missed = Counter()
+
+        ckpt.remove()
+        stats.report()
+
+
+def writechunk(out, outlines, format):
+    """ Writes outlines to out (a binary file) in format """
+    for outline in (genplaintext(outlines) if format == "plaintext" else outlines):
+        out.write(outline.encode("utf-8"))
+
+
+def targetname(outfname, target):
+    """ The output file for target: outfname with {target} filled in, or with
+    the target appended if it has no {target} """
+    if "{target}" in outfname:
+        return outfname.replace("{target}", target)
+    return outfname + "." + target
+
+
+def translate_targets(fname, outfname, targets, spec, format="conll", workers=None):
+    """ Translates fname into each of targets, writing to targetname(outfname, target).
+    spec holds the Translator arguments other than the target.
+
+    The corpus is parsed once, here, and held in memory, as are the source side
+    expansions of its words (see morph.py), and the targets are then translated in
+    a pool of processes (workers at a time, all at once by default) that are forked
+    with these already in hand.
+    Lookups and option selection are done by each target's own Translator. Returns a
+    dict of target -> TranslationStats. """
+    from concurrent.futures import ProcessPoolExecutor
+    import forkpool
+
+    if format == "conll":
+        readlines = iterconll
+    elif format == "plaintext":
+        readlines = iterplaintext
+    else:
+        print("Format not known: " + format)
+        exit()
+
+    global _sentences
+    _sentences = list(readsentences(logprogress(readlines(fname))))
+    words = {w for sent, _ in _sentences for w in sent.words if w != ""}
+    expander = morph.expander(spec["source"])
+    for w in words:
+        expander.expand(w)
+    logger.info("Parsed {0} sentences, {1} distinct words, for {2} targets".format(
+        len(_sentences), len(words), len(targets)))
+
+    if forkpool.canfork():
+        # the sentences and expansions are inherited by the forked processes.
+        pool = forkpool.ForkPool(workers or len(targets))
+        shipped = ()
+    else:
+        pool = ProcessPoolExecutor(workers or len(targets))
+        shipped = (_sentences,)
+
+    with pool:
+        futures = [(target, pool.submit(_translatetarget, dict(spec, target=target),
+                                        targetname(outfname, target), format, *shipped))
+                   for target in targets]
+        allstats = {}
+        for target, future in futures:
+            allstats[target] = future.result()
+            logger.info("{0}: wrote {1}".format(target, targetname(outfname, target)))
+            allstats[target].report()
+
+    return allstats
+
+
+# the Translator of a worker process (see Translator.translate_parallel)
+_worker = None
+
+# the parsed corpus (see translate_targets)
+_sentences = None
+
+
+def _initworker(spec):
+    global _worker
+    _worker = Translator(**spec)
+
+
+def _initforked():
+    _worker.reopen()
+
+
+def _translatechunk(lines, first):
+    return _worker.translate_chunk(lines, first)
+
+
+def _translatetarget(spec, outfname, format, sentences=None):
+    tt = Translator(**spec)
+    stats = TranslationStats()
+    if sentences is None:
+        sentences = _sentences
+    tt.prepass(sentences)
+    outlines = tt.translate_sentences(sentences, stats)
+    if format == "conll":
+        writeconll(outfname, outlines)
+    else:
+        writeplaintext(outfname, outlines)
+    return stats
+
 
 if __name__ == "__main__":
     import argparse
+    import checkpoint
     parser = argparse.ArgumentParser(description="Translate a CoNLL file")
 
     iogroup = parser.add_argument_group("io", "Arguments for IO. Both must be present.")
@@ -373,9 +879,27 @@ if __name__ == "__main__":
     iogroup.add_argument("--output", "-o", help="Output file. Format: origword  transword")
     parser.add_argument("--method", help="Either google, or lexicon", choices=["lexicon", "google"], default="lexicon")
     parser.add_argument("--source", "-s", help="Source language code (3 letter)", default="eng")
-    parser.add_argument("--target", "-t", help="Target language code (3 letter)", required=True)
+    parser.add_argument("--target", "-t", help="Target language code (3 letter)")
+    parser.add_argument("--targets", help="Comma separated target language codes, to translate the input into "
+                        "each of in one pass. The output file name gets each target in place of {target} "
+                        "(or appended)")
     parser.add_argument("--format", "-f", help="Format of input file", choices=["conll", "plaintext"], default="conll")
     parser.add_argument("--lexname", "-l", help="Name of special lexicon")
+    parser.add_argument("--workers", "-w", help="Number of processes to translate with", type=int, default=1)
+    parser.add_argument("--lmcache", help="Number of LM scores to cache (0 to turn off)", type=int, default=lmcache.DEFAULTSIZE)
+    parser.add_argument("--beam", "-b", help="Beam width for sentence-level decoding (0 is greedy)", type=int, default=0)
+    parser.add_argument("--tm", help="Translation memory database to read and add to")
+    parser.add_argument("--topk", help="When pivoting the lexicon, keep this many targets per source", type=int)
+    parser.add_argument("--minprob", help="When pivoting the lexicon, drop targets scored below this", type=float, default=0.0)
+    parser.add_argument("--checkpoint", help="Take a checkpoint about every this many sentences (for example {0}), "
+                        "to --resume from".format(checkpoint.EVERY), type=int, default=0)
+    parser.add_argument("--resume", help="Carry on from the last checkpoint of this output file", action="store_true")
+    parser.add_argument("--prepass", help="Read the input once more first, to resolve its unknown words in bulk "
+                        "(when not in chunks, with --workers or --checkpoint)", action="store_true")
+    parser.add_argument("--shared", help="Memory-map the phrase trie and LM, to share them between processes", action="store_true")
+    parser.add_argument("--profile", help="Write a json report of time spent in each stage to this file")
+    parser.add_argument("--cprofile", help="(with --profile) Also write a cProfile of the run to this file")
+    parser.add_argument("--tracemalloc", help="(with --profile) Also trace memory allocations", action="store_true")
 
     
     args = parser.parse_args()
@@ -383,11 +907,39 @@ if __name__ == "__main__":
     if bool(args.input) != bool(args.output):
         logger.error("Either both or neither input/output must be present.")
         exit()
+
+    if bool(args.target) == bool(args.targets):
+        parser.error("Exactly one of --target and --targets must be given.")
+
+    if args.targets and not args.input:
+        parser.error("--targets needs --input and --output.")
+
+    if args.targets and (args.checkpoint > 0 or args.resume):
+        parser.error("--targets can't take checkpoints or --resume.")
+
+    prof = None
+    if args.profile:
+        import sys
+        import profiler
+        prof = profiler.Profiler(args.cprofile, args.tracemalloc)
+        prof.instrument(sys.modules[__name__])
+
+    if args.targets:
+        # the stages run in the target processes, so a profile only has the parsing.
+        spec = dict(method=args.method, source=args.source, lexname=args.lexname, lmcachesize=args.lmcache,
+                    beam=args.beam, tmpath=args.tm, shared=args.shared, topk=args.topk, minprob=args.minprob)
+        translate_targets(args.input, args.output, args.targets.split(","), spec, args.format,
+                          args.workers if args.workers > 1 else None)
+        if prof is not None:
+            prof.write(args.profile)
+        exit()
     
-    tt = Translator(args.method, args.source, args.target, args.lexname)
+    tt = Translator(args.method, args.source, args.target, args.lexname, args.lmcache, args.beam, args.tm,
+                    args.shared, args.topk, args.minprob)
     
     if args.input and args.output:
-        tt.translate_file(args.input, args.output, args.format)
+        tt.translate_file(args.input, args.output, args.format, args.workers, args.checkpoint, args.resume,
+                          args.prepass)
     else:
         print("Interactively translating from {} to {}. q, Q, or exit to quit.".format(args.source, args.target))
         srctext = ""
@@ -398,3 +950,6 @@ if __name__ == "__main__":
             
             lines = plaintexttolines(srctext)
             print(args.target + ": " + linestoplaintext(tt.translate(lines))[0].strip())
+
+    if prof is not None:
+        prof.write(args.profile, tt)
@@ -0,0 +1,58 @@
+#  -*- coding: utf-8 -*-
+""" A persistent, sentence-level translation memory.
+
+Translations are kept in a SQLite table (see kvstore.py), keyed by a hash of
+the source sentence (words and tags) together with a fingerprint of everything
+else that affects the output: the lexicon, the LM and the Translator settings.
+A hit returns the stored (source index, tag, word) rows and the coverage counts
+of the sentence.
+"""
+import hashlib
+import json
+
+from kvstore import KVStore
+from utils import logger
+
+
+def fingerprint(parts):
+    """ Hash of a list of json-able settings and file stats """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf8")).hexdigest()
+
+
+class TranslationMemory:
+
+    def __init__(self, fname, fingerprint):
+        self.fname = fname
+        self.fingerprint = fingerprint
+        self.store = KVStore(fname, "tm", ["fingerprint", "key"])
+        logger.info("Using translation memory {0} ({1})".format(fname, fingerprint[:8]))
+
+    def key(self, sent, first):
+        """ The key of a sentence (a TokenTable). first matters because it decides capitalization. """
+        h = hashlib.sha1()
+        h.update(b"1" if first else b"0")
+        for tag, word in zip(sent.tags, sent.words):
+            h.update(b"\0")
+            h.update(tag.encode("utf8"))
+            h.update(b"\t")
+            h.update(word.encode("utf8"))
+        return h.hexdigest()
+
+    def get(self, key):
+        """ Returns (rows, total, missing, missedwords) for key, or None """
+        value = self.store.get((self.fingerprint, key))
+        if value is None:
+            return None
+        rows, total, missing, missedwords = json.loads(value)
+        return [tuple(r) for r in rows], total, missing, missedwords
+
+    def put(self, key, rows, total, missing, missedwords):
+        """ Store the output rows of a sentence and its coverage counts
+        (missedwords is a dict of word -> count). """
+        self.store.put((self.fingerprint, key), json.dumps((rows, total, missing, missedwords)))
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
@@ -1,6 +1,9 @@
 #  -*- coding: utf-8 -*-
 import logging
 import codecs
+import contextlib
+import os
+import string
 
 FORMAT = "[%(asctime)s] : %(filename)s.%(funcName)s():%(lineno)d - %(message)s"
 DATEFMT = '%H:%M:%S, %m/%d/%Y'
@@ -12,9 +15,20 @@ LEXICONPATH="/home/stephen/dictionaries/"
 USEMASTERLEX = False
 USEPAVLICK = True
 
+# compiled (binary) versions of the lexicon mappings are kept here.
+COMPILEDPATH = LEXICONPATH + "compiled/"
+
 # this is the path of a language model created by SRILM.
 LMPATH="/path/to/mylm.txt"
 
+# word2vec (binary format) vectors for vector expansion, if Translator.usevecs is on.
+VECPATH=""
+
+# this is a set of words to be ignored when counting translation failures
+IGNORES = set(string.punctuation)
+IGNORES.update(map(str, range(2050)))
+IGNORES.update(["-DOCSTART-", "--"])
+
 
 langmap = {
     "eng": "en",
@@ -62,13 +76,15 @@ def getapikey():
     return API_KEY
 
 
+# Google API cost per character, as of August 2016
+PRICE = 20 / 1000000.
+
+
 def cost(chars):
     """ Calculate the cost of using the API and
     confirm with the user """
 
-    # Google API cost as of August 2016
-    price = 20 / 1000000.
-    cost = price * chars
+    cost = PRICE * chars
     
     logger.info("It will cost ${:0<#4.2} to run this script.".format(cost))
     c = ""
@@ -85,6 +101,11 @@ def cost(chars):
             print("please enter y or n")
 
 
+def costprogress(done, total, chars):
+    """ Log how far through an API job we are, and what it has cost so far """
+    logger.info("Translated {0}/{1} ({2} chars, ${3:.2f})".format(done, total, chars, PRICE * chars))
+
+
 def readconll(fname):
     """ Read lines from a conll file."""
     with codecs.open(fname, "r", "utf-8") as f:
@@ -92,6 +113,26 @@ def readconll(fname):
     return lines
 
 
+def iterconll(fname):
+    """ Lazily read lines from a conll file, one at a time."""
+    with codecs.open(fname, "r", "utf-8") as f:
+        for line in f:
+            yield line
+
+
+def chunksentences(lines, size):
+    """ Groups lines into lists of at least size lines (except the last). Every chunk
+    ends at a sentence boundary, so each can be translated on its own. """
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size and getword(line) is None:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
 def writeconll(outfname, outlines):
     """ Writes conll lines out to file """
     with codecs.open(outfname, "w", "utf-8") as out:
@@ -112,6 +153,15 @@ def readplaintext(fname):
     return outlines
 
 
+def iterplaintext(fname):
+    """ Like readplaintext, but lazily yields the conll lines one sentence at a time."""
+    with codecs.open(fname, "r", "utf-8") as f:
+        for line in f:
+            for outline in plaintexttolines(line):
+                yield outline
+            yield "\n"
+
+
 def plaintexttolines(text):
     outlines = []
     words = text.split()
@@ -126,12 +176,16 @@ def plaintexttolines(text):
 
 
 def linestoplaintext(lines):
+    return list(genplaintext(lines))
+
+
+def genplaintext(lines):
+    """ Yields the sentences of conll style lines, one per line of text."""
     sent = ""
-    sents = []
     for line in lines:
         word = getword(line)
         if word is None:
-            sents.append(sent.strip() + "\n")
+            yield sent.strip() + "\n"
             sent = ""
         else:
             if len(word) > 0 and word[-1] in [".", ",", "!", ":", ";", "\""]:                
@@ -139,14 +193,35 @@ def linestoplaintext(lines):
             else:
                 sent += " " + word
             
-    if sent is not "":
-        sents.append(sent)
-    return sents
+    if sent != "":
+        yield sent
     
 
+@contextlib.contextmanager
+def atomicwrite(fname, mode="w"):
+    """ A file to write fname with. It is written under a temporary name and renamed
+    over fname when done, so readers never see a half written fname. """
+    tmpname = "{}.{}.tmp".format(fname, os.getpid())
+    try:
+        with open(tmpname, mode) as out:
+            yield out
+        os.replace(tmpname, fname)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def newerthan(fnames, sources):
+    """ True if all of fnames exist and are newer than every one of sources """
+    if not all(os.path.exists(f) for f in fnames):
+        return False
+    mtime = min(os.path.getmtime(f) for f in fnames)
+    return all(os.path.exists(s) and os.path.getmtime(s) < mtime for s in sources)
+
+
 def writeplaintext(outfname, lines):
     """ Converts conll style lines to sentences, one per line."""
-    outlines = linestoplaintext(lines)
+    outlines = genplaintext(lines)
     
     with codecs.open(outfname, "w", "utf-8") as out:
        for line in outlines:
@@ -154,36 +229,14 @@ def writeplaintext(outfname, lines):
 
 
 def englishexpand(w):
-    ret = []
-    if w[-1] == "s":
-        ret.append(w[:-1])
-    if w.endswith("ed"):
-        ret.append(w[:-2])
-                
-    return ret
+    """ Candidate stems of an English word (see morph.py) """
+    import morph
+    return morph.expander("eng").expand(w)
 
 
 def uzbekexpand(w):
-    ret = []
-
-    suffixes = ["ning", "lik", "lar", "ish", "dan", "idan", "ini","lari", "ga","ni"]
-
-    hassuffixes = True
-    modified = False
-    while hassuffixes:
-        hassuffixes = False
-        for s in suffixes:
-            if w.endswith(s):
-                modified = True
-                w = w[:-len(s)]
-                hassuffixes = True
-                
-    if modified:
-        ret.append(w)
-
-    if "ʻ" in w:
-        ret.append(w.replace("ʻ", ""))
-
-    return ret
+    """ Candidate stems of an Uzbek word (see morph.py) """
+    import morph
+    return morph.expander("uzb").expand(w)
 
 
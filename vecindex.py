@@ -0,0 +1,123 @@
+#  -*- coding: utf-8 -*-
+""" A nearest-neighbour index over word vectors, restricted to lexicon keys.
+
+Vector expansion replaces an unknown word with a similar word that is in the
+lexicon. Asking gensim for the most similar words scans the whole embedding
+vocabulary, and most of what comes back is not in the lexicon anyway. This
+index keeps two matrices of unit-length float32 vectors:
+
+    keys    one row per lexicon key that has a vector (the only candidates)
+    vocab   one row per word in the embeddings (the possible queries)
+
+so a query is one row lookup and one matrix-vector product over the lexicon
+keys, and a batch of queries is one matrix product. Both are saved as .npy
+files, and the words of their rows as compiled lexicons (see lexcache.py), and
+all of them are memory-mapped when loaded, so loading is instant and the pages
+are shared between processes.
+
+An index is written under a prefix, as prefix.keys.npy, prefix.keys.lex,
+prefix.vocab.npy and prefix.vocab.lex.
+"""
+import os
+
+import numpy as np
+
+import lexcache
+from utils import logger, atomicwrite
+
+# number of queries scored against the keys at a time in similarmany
+QUERYBLOCK = 1024
+
+
+def normalize(m):
+    """ Rows of m scaled to unit length (zero rows are left as they are), as float32 """
+    m = np.asarray(m, dtype=np.float32)
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return m / norms
+
+
+def _save(prefix, name, words, matrix):
+    with atomicwrite(prefix + name + ".npy", "wb") as f:
+        np.save(f, matrix)
+    lexcache.writelexicon({w: {} for w in words}, prefix + name + ".lex")
+
+
+def _load(prefix, name):
+    matrix = np.load(prefix + name + ".npy", mmap_mode="r")
+    return lexcache.MappedVocab(lexcache.CompiledLexicon(prefix + name + ".lex")), matrix
+
+
+class VectorIndex:
+
+    def __init__(self, keys, keymatrix, vocab, vocabmatrix):
+        """ keys and vocab are lexcache.MappedVocabs of the words of the rows of the
+        matrices, which hold their unit vectors """
+        self.keys = keys
+        self.keymatrix = keymatrix
+        self.vocab = vocab
+        self.vocabmatrix = vocabmatrix
+
+    @classmethod
+    def build(cls, vecs, lexkeys):
+        """ Build an index from gensim KeyedVectors for the words of lexkeys that have a vector """
+        vocab = list(getattr(vecs, "index_to_key", None) or vecs.index2word)
+        vocabmatrix = normalize(vecs.vectors)
+        index = {w: i for i, w in enumerate(vocab)}
+
+        keys = [k for k in lexkeys if k in index]
+        keymatrix = vocabmatrix[[index[k] for k in keys]] if len(keys) > 0 else np.zeros((0, vocabmatrix.shape[1]), np.float32)
+        logger.info("Vector index: {0} of {1} lexicon keys have vectors".format(len(keys), len(lexkeys)))
+        return cls(lexcache.MappedVocab.fromwords(keys), keymatrix, lexcache.MappedVocab.fromwords(vocab), vocabmatrix)
+
+    def save(self, prefix):
+        dirname = os.path.dirname(prefix)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        _save(prefix, ".vocab", self.vocab, self.vocabmatrix)
+        _save(prefix, ".keys", self.keys, self.keymatrix)
+        logger.info("Wrote vector index {0} ({1} keys, {2} words)".format(prefix, len(self.keys), len(self.vocab)))
+
+    @classmethod
+    def load(cls, prefix):
+        keys, keymatrix = _load(prefix, ".keys")
+        vocab, vocabmatrix = _load(prefix, ".vocab")
+        return cls(keys, keymatrix, vocab, vocabmatrix)
+
+    def __contains__(self, word):
+        return word in self.vocab
+
+    def topk(self, scores, k, exclude=None):
+        """ The best k (key, score) pairs of a row of scores, best first """
+        n = min(k + 1, len(scores))
+        if n == 0:
+            return []
+        best = np.argpartition(-scores, n - 1)[:n]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        found = [(self.keys.word(i), float(scores[i])) for i in best]
+        out = [(key, score) for key, score in found if key != exclude]
+        return out[:k]
+
+    def similar(self, word, k=10):
+        """ The k lexicon keys closest to word, as (key, cosine) pairs, best first.
+        Raises KeyError if word has no vector. """
+        q = self.vocabmatrix[self.vocab[word]]
+        return self.topk(self.keymatrix.dot(q), k, word)
+
+    def similarmany(self, words, k=10):
+        """ similar() for many words at once. Returns a dict of word -> neighbours,
+        with the words that have no vector left out. """
+        words = [w for w in dict.fromkeys(words) if w in self.vocab]
+        out = {}
+        for i in range(0, len(words), QUERYBLOCK):
+            block = words[i:i+QUERYBLOCK]
+            qs = self.vocabmatrix[[self.vocab[w] for w in block]]
+            scores = qs.dot(self.keymatrix.T)
+            for w, row in zip(block, scores):
+                out[w] = self.topk(row, k, w)
+        return out
+
+
+def filenames(prefix):
+    """ The files of the index at prefix """
+    return [prefix + name + ext for name in [".keys", ".vocab"] for ext in [".npy", ".lex"]]